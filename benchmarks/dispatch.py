@@ -0,0 +1,106 @@
+# Measures the per-update overhead of Dispatcher.handle_category as the number of handlers grows,
+# comparing the precomputed routes and the per-update filter cache with walking all groups of every category.
+# Usage (from the repository root): python -m benchmarks.dispatch --handlers 10 100 1000
+import argparse
+import asyncio
+import logging
+import time
+import types
+
+import pyrogram
+from pyrogram import filters
+
+from tgbot.enums import Category
+from tgbot.wrappers.dispatcher import Dispatcher, FilterCache
+
+
+class LegacyDispatcher(Dispatcher):
+    # The implementation used before the routes and the filter cache were introduced
+
+    async def handle_category(self, category, packet, parsed_update, handler_type, filter_cache=None):
+        log = self.client.controller.log
+        log.debug(f'Выполняется обработка категории {category.name}')
+        for group in self.categories[category].values():
+            for handler in group:
+                args = None
+                if isinstance(handler, handler_type):
+                    try:
+                        if await handler.check(self.client, parsed_update):
+                            args = (parsed_update,)
+                    except Exception:
+                        log.exception(f'Необработанное исключение при проверке обработчика {self.get_handler_name(handler)}:')
+                        return False
+                elif isinstance(handler, pyrogram.handlers.RawUpdateHandler):
+                    args = packet
+                if args is None:
+                    continue
+                try:
+                    log.debug(f'Вызывается обработчик {self.get_handler_name(handler)}')
+                    await handler.callback(*args)
+                except pyrogram.StopPropagation:
+                    return True
+                except pyrogram.ContinuePropagation:
+                    continue
+                except Exception:
+                    log.exception(f'В обработчике {self.get_handler_name(handler)} произошло необработанное исключение:')
+                    return False
+                break
+        return True
+
+
+async def reject(flt, client, update):
+    return False
+
+
+async def callback(update):
+    pass
+
+
+async def fill(dispatcher, handlers):
+    # Like the global filter, which is shared by all message handlers
+    never = filters.create(reject)
+    for i in range(handlers):
+        # Most of the handlers are for other update types or do not match
+        handler_class = pyrogram.handlers.MessageHandler if i % 4 == 0 else pyrogram.handlers.CallbackQueryHandler
+        await dispatcher.add_handler(
+            handler_class(callback, filters=never),
+            category=list(Category)[i % len(Category)],
+            group=i % 10,
+        )
+    for category in Category:
+        await dispatcher.add_handler(pyrogram.handlers.MessageHandler(callback), category=category, group=100)
+
+
+async def measure(dispatcher, updates):
+    update = types.SimpleNamespace()
+    kwargs = {'packet': (None, {}, {}), 'parsed_update': update, 'handler_type': pyrogram.handlers.MessageHandler}
+    start = time.perf_counter()
+    for _ in range(updates):
+        kwargs['filter_cache'] = FilterCache(dispatcher, dispatcher.client, update)
+        for category in (Category.INITIALIZE, Category.MAIN, Category.FINISH, Category.FINALIZE):
+            await dispatcher.handle_category(category, **kwargs)
+    return (time.perf_counter() - start) / updates * 1e6
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--handlers', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--updates', type=int, default=10000)
+    args = parser.parse_args()
+    log = logging.getLogger('benchmark')
+    log.setLevel(logging.WARNING)
+    client = types.SimpleNamespace(controller=types.SimpleNamespace(log=log))
+    print(f'{"handlers":>10} {"walk, us/update":>16} {"routes, us/update":>18} {"filter evaluations":>19} {"cache hits":>11}')
+    for handlers in args.handlers:
+        results = []
+        for dispatcher_class in (LegacyDispatcher, Dispatcher):
+            dispatcher = dispatcher_class(client)
+            await fill(dispatcher, handlers)
+            results.append(await measure(dispatcher, args.updates))
+        evaluations = sum(dispatcher.filter_evaluations.values())
+        hits = sum(dispatcher.filter_cache_hits.values())
+        print(f'{handlers:>10} {results[0]:>16.2f} {results[1]:>18.2f} {evaluations:>19} {hits:>11}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,213 @@
+# End-to-end benchmarks of cm_assistant.Controller with benchmarks.fake_client.FakeClient instead of telegram:
+# group message ingestion throughput, /admin window build time, button press round trip
+# and statistics rendering on event tables of several sizes. Results are printed as JSON.
+# Usage (from the repository root): python -m benchmarks.e2e --sizes 10000 100000 --output results.json
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import tempfile
+import time
+
+import pyrogram
+from sqlalchemy import update
+
+from benchmarks.fake_client import make_callback_query_packet, make_message_packet
+from benchmarks.replay import configure_environment, feed, make_controller_class, start_controller
+from tgbot.enums import Category
+
+ADMIN_ID = 1000
+GROUP_CHAT_ID = -1001000000001
+YEAR = 365*24*60*60
+CHUNK_SIZE = 50000
+ROUND_TRIP_TIMEOUT = 60
+
+
+class Session:
+    # Drives the bot like a telegram user would
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.client = controller.app
+        self.message_ids = itertools.count(1)
+        self.query_ids = itertools.count(1)
+        self.handled = asyncio.Event()
+
+    async def on_update_handled(self, *args):
+        self.handled.set()
+
+    async def install(self):
+        # The last handler of every update
+        await self.client.dispatcher.add_handler(
+            pyrogram.handlers.RawUpdateHandler(self.on_update_handled),
+            category=Category.FINALIZE,
+            group=10**9,
+        )
+
+    async def round_trip(self, packet):
+        # Seconds from receiving the update to the end of its handling, including blocking sends
+        self.handled.clear()
+        start = time.perf_counter()
+        self.client.feed(packet)
+        # Updates that fail before the handlers (e.g. in parsing) never reach the last one
+        await asyncio.wait_for(self.handled.wait(), ROUND_TRIP_TIMEOUT)
+        return time.perf_counter() - start
+
+    async def send_text(self, text, chat_id=ADMIN_ID, user_id=ADMIN_ID):
+        return await self.round_trip(make_message_packet(chat_id, user_id, text, next(self.message_ids)))
+
+    async def press(self, button_text, chat_id=ADMIN_ID):
+        message = self.client.last_messages[chat_id]
+        for row in message.reply_markup.inline_keyboard:
+            for button in row:
+                if button.text.endswith(button_text):
+                    packet = make_callback_query_packet(chat_id, ADMIN_ID, message.id, button.callback_data, next(self.query_ids))
+                    return await self.round_trip(packet)
+        raise ValueError(f'Button {button_text} not found in {message.text!r}')
+
+
+def summarize(times):
+    times = sorted(time * 1000 for time in times)
+    return {
+        'runs': len(times),
+        'mean_ms': statistics.mean(times),
+        'p50_ms': statistics.median(times),
+        'p99_ms': times[int(len(times)*0.99)],
+        'max_ms': times[-1],
+    }
+
+
+async def create_admin_group(controller):
+    from enums import UserRole
+    from tables import Group, GroupUserAssociation, User
+    async with controller.session() as session:
+        group = Group(group_id=GROUP_CHAT_ID, remove_joins=False, remove_leaves=False)
+        user = User(user_id=ADMIN_ID)
+        session.add_all([group, user, GroupUserAssociation(group=group, user=user, role=UserRole.ADMIN)])
+        await session.commit()
+        return group.id
+
+
+async def fill_events(controller, group_id, count):
+    # Through the event writer, so that the rollups and the sketches are filled too
+    from enums import EventType
+    now = int(time.time())
+    types = [EventType.MESSAGE]*18 + [EventType.JOIN, EventType.LEAVE]
+    for offset in range(0, count, CHUNK_SIZE):
+        rows = [{
+            'group_id': group_id,
+            'user_id': random.randint(1, 100000),
+            'time': now - random.randint(0, YEAR),
+            'type': random.choice(types),
+        } for _ in range(min(CHUNK_SIZE, count-offset))]
+        async with controller.session() as session:
+            await controller.event_writer.write(session, rows)
+            await session.commit()
+
+
+async def bench_ingestion(controller, updates, users):
+    packets = [
+        make_message_packet(GROUP_CHAT_ID, random.randint(1, users), 'hello', number)
+        for number in range(1, updates+1)
+    ]
+    start = time.perf_counter()
+    await feed(controller, packets, 1000)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    await controller.event_writer.flush()
+    return {
+        'updates': updates,
+        'updates_per_second': updates / elapsed,
+        'final_flush_ms': (time.perf_counter() - start) * 1000,
+    }
+
+
+async def bench_admin_window(session, runs):
+    return summarize([await session.send_text('/admin') for _ in range(runs)])
+
+
+async def bench_button_press(session, runs):
+    await session.send_text('/admin')
+    times = []
+    for _ in range(runs):
+        # To the group settings and back
+        times.append(await session.press(f'Group {GROUP_CHAT_ID}'))
+        times.append(await session.press('Назад'))
+    return summarize(times)
+
+
+async def bench_stats(session, group_id, sizes, runs):
+    from tables import GroupStatsTab
+    controller = session.controller
+    results = []
+    filled = 0
+    for size in sizes:
+        start = time.perf_counter()
+        await fill_events(controller, group_id, size - filled)
+        filled = size
+        fill_time = time.perf_counter() - start
+        await session.send_text('/admin')
+        await session.press(f'Group {GROUP_CHAT_ID}')
+        await session.press('Статистика')
+        await session.press('Далее')
+        await session.press('Далее')
+        # The whole year instead of the default empty range
+        now = datetime.datetime.now()
+        async with controller.session() as db_session:
+            await db_session.execute(update(GroupStatsTab).values(start_date_time=now - datetime.timedelta(seconds=YEAR), end_date_time=now))
+            await db_session.commit()
+        times = [await session.press('Обновить') for _ in range(runs)]
+        results.append({'events': size, 'fill_seconds': fill_time, **summarize(times)})
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10**4, 10**5], help='numbers of events for the statistics, up to 10**7')
+    parser.add_argument('--updates', type=int, default=10000, help='group messages for the ingestion benchmark')
+    parser.add_argument('--users', type=int, default=1000, help='distinct senders of the group messages')
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--db-url', help='empty database to use instead of a temporary sqlite file, e.g. postgresql+asyncpg://...')
+    parser.add_argument('--output', help='file for the JSON results, stdout by default')
+    args = parser.parse_args()
+    output_path = os.path.abspath(args.output) if args.output else None
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_environment(workdir, args.db_url)
+        os.chdir(workdir)
+        controller = make_controller_class(args.workers)()
+        controller_task = await start_controller(controller)
+        try:
+            session = Session(controller)
+            await session.install()
+            group_id = await create_admin_group(controller)
+            results = {
+                'python': platform.python_version(),
+                'database': controller.db_engine.dialect.name,
+                'workers': args.workers,
+                'ingestion': await bench_ingestion(controller, args.updates, args.users),
+                'admin_window': await bench_admin_window(session, args.runs),
+                'button_press': await bench_button_press(session, args.runs),
+                'stats': await bench_stats(session, group_id, sorted(args.sizes), args.runs),
+                'api_calls': dict(controller.app.calls),
+                'handler_exceptions': dict(controller.app.dispatcher.handler_exceptions),
+            }
+        finally:
+            controller.stop()
+            await controller_task
+    output = json.dumps(results, indent=2)
+    if output_path:
+        with open(output_path, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,197 @@
+# In-process stand-in for pyrogram.Client: updates are fed directly into the dispatcher,
+# and the api methods used by the bot answer locally without a network connection.
+import asyncio
+from collections import Counter
+import datetime
+from io import BytesIO
+import itertools
+
+import pyrogram
+from pyrogram import raw, types
+from pyrogram.raw.core import TLObject
+from pyrogram.enums import ChatMemberStatus, ChatType
+
+BOT_ID = 10**9
+BOT_USERNAME = 'fake_bot'
+
+
+class FakeClient(pyrogram.Client):
+
+    def __init__(self, workers=1, api_delay=0):
+        super().__init__(
+            'fake',
+            api_id=1,
+            api_hash='fake',
+            bot_token=f'{BOT_ID}:fake',
+            in_memory=True,
+            workers=workers,
+            parse_mode=pyrogram.enums.ParseMode.HTML,
+        )
+        # Simulated round trip of every api call in seconds
+        self.api_delay = api_delay
+        # Method name -> number of calls
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+        # Username -> user id, for get_users with usernames
+        self.usernames = {}
+        self.chat_member_status = ChatMemberStatus.OWNER
+        # Chat id -> the last message sent or edited there
+        self.last_messages = {}
+        self.started = asyncio.Event()
+
+    async def start(self):
+        await self.storage.open()
+        self.me = types.User(id=BOT_ID, is_bot=True, first_name='Fake', username=BOT_USERNAME, client=self)
+        await self.dispatcher.start()
+        self.started.set()
+        return self
+
+    async def stop(self, block=True):
+        await self.dispatcher.stop()
+        await self.storage.close()
+        self.started.clear()
+        return self
+
+    def feed(self, packet):
+        # Like pyrogram.Client.handle_updates
+        self.dispatcher.updates_queue.put_nowait(packet)
+
+    async def call(self, name):
+        self.calls[name] += 1
+        if self.api_delay:
+            await asyncio.sleep(self.api_delay)
+
+    async def invoke(self, query, *args, **kwargs):
+        # There is no server, methods without a stub below fail like for an unknown peer
+        self.calls[type(query).__name__] += 1
+        raise pyrogram.errors.PeerIdInvalid()
+
+    def make_chat(self, chat_id):
+        if chat_id > 0:
+            return types.Chat(id=chat_id, type=ChatType.PRIVATE, first_name=f'User {chat_id}', client=self)
+        return types.Chat(id=chat_id, type=ChatType.SUPERGROUP, title=f'Group {chat_id}', client=self)
+
+    def make_user(self, user_id, username=None):
+        return types.User(id=user_id, is_bot=False, first_name=f'User {user_id}', username=username, client=self)
+
+    def make_message(self, chat_id, text=None, message_id=None, reply_markup=None):
+        return types.Message(
+            id=message_id or next(self.message_ids),
+            chat=self.make_chat(chat_id),
+            from_user=self.me,
+            date=datetime.datetime.now(),
+            text=text,
+            reply_markup=reply_markup,
+            outgoing=True,
+            client=self,
+        )
+
+    def store_message(self, message):
+        # Callback queries to this message are parsed with it, like in pyrogram
+        self.message_cache[(message.chat.id, message.id)] = message
+        self.last_messages[message.chat.id] = message
+        return message
+
+    async def send_message(self, chat_id, text, *args, reply_markup=None, **kwargs):
+        await self.call('send_message')
+        return self.store_message(self.make_message(chat_id, text, reply_markup=reply_markup))
+
+    async def edit_message_text(self, chat_id, message_id, text, *args, reply_markup=None, **kwargs):
+        await self.call('edit_message_text')
+        return self.store_message(self.make_message(chat_id, text, message_id, reply_markup))
+
+    async def delete_messages(self, chat_id, message_ids, *args, **kwargs):
+        await self.call('delete_messages')
+        return len(message_ids) if isinstance(message_ids, list) else 1
+
+    async def get_messages(self, chat_id, message_ids=None, *args, **kwargs):
+        await self.call('get_messages')
+        if isinstance(message_ids, list):
+            return [self.message_cache[(chat_id, message_id)] or self.make_message(chat_id, message_id=message_id) for message_id in message_ids]
+        return self.message_cache[(chat_id, message_ids)] or self.make_message(chat_id, message_id=message_ids)
+
+    async def get_chat(self, chat_id, *args, **kwargs):
+        await self.call('get_chat')
+        return self.make_chat(chat_id)
+
+    async def get_users(self, user_ids, *args, **kwargs):
+        await self.call('get_users')
+        if not isinstance(user_ids, list):
+            return self.make_user(user_ids)
+        users = []
+        for user_id in user_ids:
+            if isinstance(user_id, str):
+                if user_id.lstrip('@') not in self.usernames:
+                    continue
+                users.append(self.make_user(self.usernames[user_id.lstrip('@')], user_id.lstrip('@')))
+            else:
+                users.append(self.make_user(user_id))
+        return users
+
+    async def get_chat_member(self, chat_id, user_id, *args, **kwargs):
+        await self.call('get_chat_member')
+        return types.ChatMember(status=self.chat_member_status, user=self.make_user(user_id), chat=self.make_chat(chat_id), client=self)
+
+    async def leave_chat(self, chat_id, *args, **kwargs):
+        await self.call('leave_chat')
+
+    async def answer_callback_query(self, *args, **kwargs):
+        await self.call('answer_callback_query')
+        return True
+
+    async def send_document(self, chat_id, document, *args, **kwargs):
+        await self.call('send_document')
+        return self.make_message(chat_id)
+
+
+def normalize(obj):
+    # Objects read from the network have empty lists instead of None for missing vectors
+    return TLObject.read(BytesIO(obj.write()))
+
+
+def normalize_packet(update, users, chats):
+    return (
+        normalize(update),
+        {user_id: normalize(user) for user_id, user in users.items()},
+        {chat_id: normalize(chat) for chat_id, chat in chats.items()},
+    )
+
+
+def make_user(user_id, username=None):
+    return raw.types.User(id=user_id, access_hash=user_id, first_name=f'User {user_id}', username=username)
+
+
+def make_channel(channel_id):
+    return raw.types.Channel(id=channel_id, title=f'Group {channel_id}', photo=raw.types.ChatPhotoEmpty(), date=0, access_hash=channel_id, megagroup=True)
+
+
+def make_message_packet(chat_id, user_id, text, message_id, action=None):
+    # Raw packet of a message from user_id, chat_id is a private chat if positive and a supergroup otherwise
+    users = {user_id: make_user(user_id)}
+    chats = {}
+    if chat_id > 0:
+        peer = raw.types.PeerUser(user_id=chat_id)
+    else:
+        channel_id = pyrogram.utils.get_channel_id(chat_id)
+        peer = raw.types.PeerChannel(channel_id=channel_id)
+        chats[channel_id] = make_channel(channel_id)
+    from_id = raw.types.PeerUser(user_id=user_id)
+    if action is not None:
+        message = raw.types.MessageService(id=message_id, peer_id=peer, from_id=from_id, date=0, action=action)
+    else:
+        message = raw.types.Message(id=message_id, peer_id=peer, from_id=from_id, date=0, message=text)
+    update_class = raw.types.UpdateNewMessage if chat_id > 0 else raw.types.UpdateNewChannelMessage
+    return normalize_packet(update_class(message=message, pts=0, pts_count=0), users, chats)
+
+
+def make_callback_query_packet(chat_id, user_id, message_id, data, query_id):
+    users = {user_id: make_user(user_id)}
+    update = raw.types.UpdateBotCallbackQuery(
+        query_id=query_id,
+        user_id=user_id,
+        peer=raw.types.PeerUser(user_id=chat_id),
+        msg_id=message_id,
+        chat_instance=0,
+        data=data if isinstance(data, bytes) else data.encode(),
+    )
+    return normalize_packet(update, users, {})
@@ -0,0 +1,96 @@
+# Compares the list-based Limiter with the GCRA TokenBucketLimiter:
+# the cost of a call that does not wait for different amounts, and the accuracy under thousands of concurrent waiters
+# (the achieved rate and the biggest number of actions within any period, which must not exceed amount+burst-1;
+# the actual times may go over it by the event loop lag, the times planned by the limiter may not).
+# Usage (from the repository root): python -m benchmarks.limiter --waiters 5000 --rate 1000
+import argparse
+import asyncio
+import logging
+import time
+import types
+
+from tgbot.limiter import Limiter, TokenBucketLimiter
+
+CLOCK_SLACK = 10**-4
+
+
+def max_in_window(times, period):
+    # Two pointers over the sorted times, a window is [start, start+period).
+    # Times are taken with a separate clock reading after the limiter call,
+    # so actions planned exactly period apart may come out a few microseconds closer.
+    period -= CLOCK_SLACK
+    best = 0
+    first = 0
+    for last, end in enumerate(times):
+        while end - times[first] >= period:
+            first += 1
+        best = max(best, last - first + 1)
+    return best
+
+
+async def measure_overhead(limiter, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        await limiter()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+async def measure_accuracy(limiter, waiters, tokens=1):
+    # Planned times are the ones given out by TokenBucketLimiter.reserve,
+    # actual ones also include the event loop lag of thousands of sleeping tasks
+    planned = []
+    actual = []
+    async def waiter():
+        if isinstance(limiter, TokenBucketLimiter):
+            delay = limiter.reserve(tokens)
+            planned.extend([time.monotonic() + delay] * tokens)
+            await asyncio.sleep(delay)
+        else:
+            await limiter()
+        actual.extend([time.monotonic()] * tokens)
+    start = time.monotonic()
+    await asyncio.gather(*[waiter() for _ in range(waiters)])
+    planned.sort()
+    actual.sort()
+    return {
+        'rate': len(actual) / (actual[-1] - start),
+        'planned_max_in_period': max_in_window(planned, limiter.period) if planned else None,
+        'actual_max_in_period': max_in_window(actual, limiter.period),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--waiters', type=int, default=5000)
+    parser.add_argument('--rate', type=int, default=1000, help='actions per second for the accuracy test')
+    parser.add_argument('--burst', type=int, default=10)
+    parser.add_argument('--calls', type=int, default=20000)
+    args = parser.parse_args()
+    log = logging.getLogger('benchmark')
+    log.setLevel(logging.WARNING)
+    controller = types.SimpleNamespace(log=log)
+    print(f'{"amount":>8} {"Limiter, us/call":>17} {"TokenBucketLimiter, us/call":>28}')
+    for amount in (30, 1000, 100000):
+        # The period is tiny, so that the calls never wait
+        results = [
+            await measure_overhead(limiter_class(controller, amount, 1e-9), args.calls)
+            for limiter_class in (Limiter, TokenBucketLimiter)
+        ]
+        print(f'{amount:>8} {results[0]:>17.2f} {results[1]:>28.2f}')
+    print()
+    print(f'{args.waiters} concurrent waiters, {args.rate} actions per second')
+    print(f'{"limiter":>30} {"actions/s":>10} {"max in period (planned / actual)":>33} {"allowed":>8}')
+    cases = (
+        ('Limiter', Limiter(controller, args.rate, 1), 1, args.rate),
+        ('TokenBucketLimiter', TokenBucketLimiter(controller, args.rate, 1), 1, args.rate),
+        (f'TokenBucketLimiter burst {args.burst}', TokenBucketLimiter(controller, args.rate, 1, burst=args.burst), 1, args.rate + args.burst - 1),
+        (f'acquire({args.burst}) burst {args.burst}', TokenBucketLimiter(controller, args.rate, 1, burst=args.burst), args.burst, args.rate + args.burst - 1),
+    )
+    for name, limiter, tokens, allowed in cases:
+        result = await measure_accuracy(limiter, args.waiters // tokens, tokens)
+        max_in_period = f'{result["planned_max_in_period"] or "-"} / {result["actual_max_in_period"]}'
+        print(f'{name:>30} {result["rate"]:>10.0f} {max_in_period:>33} {allowed:>8}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,135 @@
+# Outgoing message scheduling of TGBotMessagesMixin with the default telegram limits:
+# a group gets a long backlog (e.g. a multi-part report), which its chat limiter lets out in a burst of 20 and then one message every 3 seconds,
+# while many private chats get one message each. Their latency should only depend on the global limit,
+# not on the group backlog, and the messages of every chat should be sent in order.
+# With --memory-backlog it instead measures the memory held by a backlog of queued messages
+# (e.g. a mailing or an error storm to DEV_IDS), compared with queue entries that hold a ready coroutine.
+# Usage (from the repository root): python -m benchmarks.message_queue --backlog 200 --chats 100
+# or: python -m benchmarks.message_queue --memory-backlog 100000 --chats 1000
+import argparse
+import asyncio
+from dataclasses import dataclass, field
+import heapq
+import logging
+import statistics
+import time
+import tracemalloc
+from typing import Any
+
+from tgbot.messages import TGBotMessagesMixin
+
+GROUP_CHAT_ID = -1001000000001
+MAX_CONCURRENT_SENDINGS = 23
+
+
+class FakeApp:
+    # Applies the limiters like the invoke wrapper of tgbot.exception_handler does
+
+    def __init__(self, api_delay):
+        self.api_delay = api_delay
+        # Chat id -> texts in the order they were sent
+        self.sent = {}
+        # Chat id -> time of the last sent message
+        self.sent_at = {}
+
+    async def send_message(self, chat_id, text, *args, limiters=None, ignore_errors=False, **kwargs):
+        for limiter in limiters or []:
+            await limiter()
+        await asyncio.sleep(self.api_delay)
+        self.sent.setdefault(chat_id, []).append(text)
+        self.sent_at[chat_id] = time.perf_counter()
+
+
+class Controller(TGBotMessagesMixin):
+
+    def __init__(self, api_delay):
+        self.log = logging.getLogger('benchmark')
+        self.log.setLevel(logging.WARNING)
+        self.app = FakeApp(api_delay)
+        self.dev_ids = []
+        super().__init__()
+
+
+@dataclass(order=True)
+class EagerEntry:
+    # Queue entry with the api call coroutine created at once, as the messages were queued before
+    priority: int
+    id: int
+    item: Any=field(compare=False)
+
+
+def queue_eager(controller, backlog, chats):
+    queue = []
+    limiters = [controller.global_message_limiter]
+    for number in range(backlog):
+        chat_id = number % chats + 1
+        message_data = {
+            'coroutine': controller.app.send_message(chat_id, 'message text', limiters=limiters+[controller.message_limiters.get(chat_id)]),
+            'priority': 2,
+            'message_id': number,
+            'chat_id': chat_id,
+            'ignore_errors': False,
+            'finish_event': None,
+        }
+        heapq.heappush(queue, EagerEntry(2, number, message_data))
+    return queue
+
+
+def queue_lanes(controller, backlog, chats):
+    for number in range(backlog):
+        controller.send_message_sync('message text', chat_id=number % chats + 1)
+    return controller.message_queue
+
+
+async def measure_backlog_memory(backlog, chats):
+    print(f'{backlog} queued messages to {chats} chats')
+    for name, queue_messages in (('coroutine per entry', queue_eager), ('lanes', queue_lanes)):
+        controller = Controller(0)
+        # Limiters of the chats exist in both cases
+        for chat_id in range(1, chats+1):
+            controller.message_limiters.get(chat_id)
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        queued = queue_messages(controller, backlog, chats)
+        size = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(before, 'filename'))
+        tracemalloc.stop()
+        print(f'{name:>20}: {size / 2**20:.1f} MiB, {size / backlog:.0f} bytes per message')
+        if isinstance(queued, list):
+            for entry in queued:
+                entry.item['coroutine'].close()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backlog', type=int, default=200, help='messages queued for the group first')
+    parser.add_argument('--chats', type=int, default=100, help='private chats with one message each, queued after the backlog, or the chats of the memory backlog')
+    parser.add_argument('--api-delay', type=float, default=0.05, help='simulated round trip of send_message in seconds')
+    parser.add_argument('--memory-backlog', type=int, help='queued messages for the memory benchmark')
+    args = parser.parse_args()
+    if args.memory_backlog:
+        await measure_backlog_memory(args.memory_backlog, args.chats)
+        return
+    controller = Controller(args.api_delay)
+    sender = asyncio.create_task(controller.message_sender(MAX_CONCURRENT_SENDINGS))
+    for number in range(args.backlog):
+        controller.send_message_sync(str(number), chat_id=GROUP_CHAT_ID)
+    start = time.perf_counter()
+    events = [controller.send_message_sync(str(chat_id), chat_id=chat_id, blocking=True) for chat_id in range(1, args.chats+1)]
+    await asyncio.gather(*[event.wait() for event in events])
+    elapsed = time.perf_counter() - start
+    sent = controller.app.sent
+    latencies = sorted(controller.app.sent_at[chat_id] - start for chat_id in range(1, args.chats+1))
+    print(f'{args.chats} private messages sent in {elapsed:.2f} s behind a backlog of {args.backlog} group messages')
+    print(f'latency: mean {statistics.mean(latencies):.2f} s, p50 {statistics.median(latencies):.2f} s, max {latencies[-1]:.2f} s')
+    group_sent = sent.get(GROUP_CHAT_ID, [])
+    print(f'group messages sent meanwhile: {len(group_sent)}, in order: {group_sent == [str(number) for number in range(len(group_sent))]}')
+    print(f'lanes: {len(controller.message_queue)}, sending: {controller.messages_info[2]["processing"]}')
+    sender.cancel()
+    try:
+        await sender
+    except asyncio.CancelledError:
+        pass
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
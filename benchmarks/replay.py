@@ -0,0 +1,111 @@
+# Replays updates recorded with UPDATES_RECORD_PATH through the full handler stack of cm_assistant.Controller,
+# with benchmarks.fake_client.FakeClient instead of telegram and a fresh local SQLite database,
+# as fast as possible, and reports the throughput and the latency of every handler.
+# With one worker (the default) the updates are handled strictly one by one in the recorded order.
+# Updates which were shed while the bot was overloaded are passed to Controller.shed_update, as they were then.
+# Usage (from the repository root): python -m benchmarks.replay updates.rec --workers 1
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from benchmarks.fake_client import FakeClient
+from tgbot.metrics import format_histogram
+from tgbot.update_recorder import read_updates
+
+
+def configure_environment(workdir, db_url=None):
+    # BotController reads its settings from the environment
+    for var, value in (('API_ID', '1'), ('API_HASH', 'fake'), ('BOT_TOKEN', '1:fake'), ('DEV_IDS', '1')):
+        os.environ.setdefault(var, value)
+    os.environ['DB_URL'] = db_url or f'sqlite+aiosqlite:///{os.path.join(workdir, "db.sqlite3")}'
+    os.environ.pop('UPDATES_RECORD_PATH', None)
+    os.environ.pop('METRICS_PORT', None)
+    os.environ.pop('MESSAGE_QUEUE_PATH', None)
+
+
+def make_controller_class(workers):
+    # Imported after configure_environment, tgbot loads .env on import
+    from cm_assistant import Controller
+    from tables import Base
+
+    class ReplayController(Controller):
+
+        def create_client(self):
+            return FakeClient(workers=workers)
+
+        async def init_db(self):
+            await super().init_db()
+            async with self.db_engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+
+    return ReplayController
+
+
+async def start_controller(controller):
+    # Runs BotController.start in a task until the client is started
+    for handler in controller.log.handlers:
+        if type(handler) is logging.StreamHandler:
+            handler.setLevel(logging.WARNING)
+    controller_task = asyncio.create_task(controller.start())
+    while controller.app is None or not controller.app.started.is_set():
+        await asyncio.sleep(0.01)
+    return controller_task
+
+
+async def feed(controller, records, max_queued):
+    # Returns the number of updates passed to shed_update
+    dispatcher = controller.app.dispatcher
+    handled = dispatcher.update_latency.count
+    shed = 0
+    for packet, was_shed in records:
+        if was_shed and controller.shed_update(packet):
+            shed += 1
+            continue
+        # Stay below the overload watermark, the recording is replayed as it was handled
+        while dispatcher.updates_queue.qsize() >= max_queued:
+            await asyncio.sleep(0.001)
+        controller.app.feed(packet)
+        handled += 1
+    while dispatcher.update_latency.count < handled:
+        await asyncio.sleep(0.01)
+    return shed
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recording')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--max-queued', type=int, default=1000)
+    parser.add_argument('--workdir', help='directory for the database and the logs, temporary by default')
+    args = parser.parse_args()
+    records = [(packet, shed) for record_time, packet, shed in read_updates(args.recording)]
+    print(f'{len(records)} updates loaded, {sum(shed for packet, shed in records)} of them were shed')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        workdir = args.workdir or temp_dir
+        os.makedirs(workdir, exist_ok=True)
+        configure_environment(workdir)
+        os.chdir(workdir)
+        controller = make_controller_class(args.workers)()
+        controller_task = await start_controller(controller)
+        start = time.perf_counter()
+        shed = await feed(controller, records, args.max_queued)
+        elapsed = time.perf_counter() - start
+        dispatcher = controller.app.dispatcher
+        controller.stop()
+        await controller_task
+    print(f'{len(records) / elapsed:.0f} updates/s, {shed} shed (time in ms)')
+    print(format_histogram('update', dispatcher.update_latency))
+    for category, histogram in dispatcher.category_latency.items():
+        print(format_histogram(category.name, histogram))
+    for name, histogram in sorted(dispatcher.handler_latency.items(), key=lambda item: item[1].sum, reverse=True):
+        print(format_histogram(name, histogram))
+    for name, count in dispatcher.handler_exceptions.most_common():
+        print(f'exceptions in {name}: {count}')
+    print('api calls: ' + ', '.join(f'{name}: {count}' for name, count in controller.app.calls.most_common()))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
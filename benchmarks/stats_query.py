@@ -0,0 +1,94 @@
+# Compares the old GroupStatsTab row scan with the GROUP BY query from stats.count_events.
+# Usage (from the repository root): python -m benchmarks.stats_query --sizes 10000 100000 1000000
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import insert, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from enums import EventType
+from stats import count_events
+from tables import Base, Event
+
+YEAR = 365*24*60*60
+CHUNK_SIZE = 50000
+
+
+async def fill_events(session, size, groups):
+    now = int(time.time())
+    types = [EventType.MESSAGE]*18 + [EventType.JOIN, EventType.LEAVE]
+    for offset in range(0, size, CHUNK_SIZE):
+        rows = [{
+            'group_id': random.randint(1, groups),
+            'user_id': random.randint(1, 100000),
+            'time': now - random.randint(0, YEAR),
+            'type': random.choice(types),
+        } for _ in range(min(CHUNK_SIZE, size-offset))]
+        await session.execute(insert(Event), rows)
+    await session.commit()
+    return now
+
+
+async def scan_events(session, group_id, start_timestamp, end_timestamp):
+    # The implementation used before the GROUP BY query
+    stmt = select(Event).where(
+        Event.time >= start_timestamp,
+        Event.time <= end_timestamp,
+        Event.group_id == group_id,
+    )
+    counts = {event_type: 0 for event_type in EventType}
+    for event in (await session.execute(stmt)).scalars():
+        counts[event.type] += 1
+    return counts
+
+
+async def measure(session_factory, func, *args, repeat):
+    best = None
+    for _ in range(repeat):
+        async with session_factory() as session:
+            start = time.perf_counter()
+            result = await func(session, *args)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+async def run_size(size, groups, repeat, directory):
+    path = os.path.join(directory, f'stats_{size}.sqlite3')
+    engine = create_async_engine(f'sqlite+aiosqlite:///{path}')
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    session_factory = sessionmaker(engine, AsyncSession, expire_on_commit=False)
+    async with session_factory() as session:
+        now = await fill_events(session, size, groups)
+    args = (1, now-YEAR, now)
+    scan_time, scan_result = await measure(session_factory, scan_events, *args, repeat=repeat)
+    group_by_time, group_by_result = await measure(session_factory, count_events, *args, repeat=repeat)
+    assert scan_result == group_by_result
+    async with engine.begin() as connection:
+        await connection.execute(text('DROP INDEX ix_event_group_id_time_type'))
+    no_index_time, _ = await measure(session_factory, count_events, *args, repeat=repeat)
+    await engine.dispose()
+    return scan_time, group_by_time, no_index_time
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    print(f'{"events":>10} {"row scan, s":>14} {"group by, s":>14} {"no index, s":>14}')
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            scan_time, group_by_time, no_index_time = await run_size(size, args.groups, args.repeat, directory)
+            print(f'{size:>10} {scan_time:>14.4f} {group_by_time:>14.4f} {no_index_time:>14.4f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,147 @@
+# Load generator for the dispatcher update queues: throughput, latency and ordering
+# of the shared queue versus the per-chat queues of the sharded mode, with one chat much slower than the others,
+# and queue wait of interactive (private) updates versus bulk (group) ones.
+# Usage (from the repository root): python -m benchmarks.update_queue --chats 100 --updates 10000 --rate 2000
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import time
+import types
+
+import pyrogram
+from pyrogram import raw
+
+from tgbot.enums import Category, UpdatePriority
+from tgbot.wrappers.dispatcher import Dispatcher
+from tgbot.wrappers.update_queue import ShardedUpdateQueue, UpdateQueue
+
+
+class FIFOUpdateQueue(UpdateQueue):
+    # The shared queue without priorities
+
+    def get_priority(self, packet):
+        return UpdatePriority.BULK
+
+
+def make_update(chat_id, number, private):
+    if private:
+        message = raw.types.Message(id=number, peer_id=raw.types.PeerUser(user_id=chat_id), date=0, message='')
+        return raw.types.UpdateNewMessage(message=message, pts=0, pts_count=0)
+    message = raw.types.Message(id=number, peer_id=raw.types.PeerChannel(channel_id=chat_id), date=0, message='')
+    return raw.types.UpdateNewChannelMessage(message=message, pts=0, pts_count=0)
+
+
+class LoadGenerator:
+
+    def __init__(self, chats, slow_chats, handler_time, slow_handler_time, private_share):
+        self.chats = chats
+        self.private_share = private_share
+        self.slow_chats = slow_chats
+        self.handler_time = handler_time
+        self.slow_handler_time = slow_handler_time
+        self.sent_at = {}
+        self.latencies = []
+        self.private_latencies = []
+        self.last_numbers = {}
+        self.reordered = 0
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    async def handle(self, update, users, chats):
+        private = isinstance(update.message.peer_id, raw.types.PeerUser)
+        chat_id = update.message.peer_id.user_id if private else update.message.peer_id.channel_id
+        number = update.message.id
+        # Simulates waiting for the database and telegram
+        slow = not private and chat_id <= self.slow_chats
+        await asyncio.sleep(random.uniform(0.5, 1.5) * (self.slow_handler_time if slow else self.handler_time))
+        # Updates of a chat finished out of the order of arrival
+        key = (private, chat_id)
+        if number < self.last_numbers.get(key, -1):
+            self.reordered += 1
+        self.last_numbers[key] = max(number, self.last_numbers.get(key, -1))
+        latency = time.perf_counter() - self.sent_at[number]
+        self.latencies.append(latency)
+        if private:
+            self.private_latencies.append(latency)
+        if len(self.latencies) == self.expected:
+            self.done.set()
+
+    async def run(self, dispatcher, updates, rate):
+        self.expected = updates
+        start = time.perf_counter()
+        for number in range(updates):
+            chat_id = random.randint(1, self.chats)
+            private = random.random() < self.private_share
+            self.sent_at[number] = time.perf_counter()
+            dispatcher.updates_queue.put_nowait((make_update(chat_id, number, private), {}, {}))
+            # Keep the requested rate
+            delay = start + (number+1)/rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await self.done.wait()
+        return time.perf_counter() - start
+
+
+async def run_mode(queue_class, args):
+    log = logging.getLogger('benchmark')
+    log.setLevel(logging.WARNING)
+    client = types.SimpleNamespace(
+        controller=types.SimpleNamespace(log=log),
+        no_updates=False,
+        workers=args.workers,
+    )
+    dispatcher = Dispatcher(client)
+    dispatcher.updates_queue_class = queue_class
+    # Raw updates are not parsed, so no real client is needed
+    dispatcher.update_parsers = {}
+    generator = LoadGenerator(args.chats, args.slow_chats, args.handler_time, args.slow_handler_time, args.private_share)
+    await dispatcher.add_handler(pyrogram.handlers.RawUpdateHandler(generator.handle), category=Category.MAIN)
+    await dispatcher.start()
+    elapsed = await generator.run(dispatcher, args.updates, args.rate)
+    wait_stats = dispatcher.updates_queue.wait_stats
+    await dispatcher.stop()
+    latencies = sorted(generator.latencies)
+    private_latencies = sorted(generator.private_latencies) or [0]
+    def mean_wait(priority):
+        stats = wait_stats[priority]
+        return stats['wait_time'] / stats['count'] * 1000 if stats['count'] else 0
+    return {
+        'private_p99': private_latencies[int(len(private_latencies)*0.99)] * 1000,
+        'interactive_wait': mean_wait(UpdatePriority.INTERACTIVE),
+        'bulk_wait': mean_wait(UpdatePriority.BULK),
+        'throughput': args.updates / elapsed,
+        'p50': statistics.median(latencies) * 1000,
+        'p99': latencies[int(len(latencies)*0.99)] * 1000,
+        'max': latencies[-1] * 1000,
+        'reordered': generator.reordered,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--slow-chats', type=int, default=1)
+    parser.add_argument('--updates', type=int, default=10000)
+    parser.add_argument('--rate', type=float, default=2000, help='updates per second')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--handler-time', type=float, default=0.001)
+    parser.add_argument('--slow-handler-time', type=float, default=0.02)
+    parser.add_argument('--private-share', type=float, default=0.05, help='share of private (interactive) updates')
+    args = parser.parse_args()
+    print(
+        f'{"mode":>12} {"updates/s":>10} {"p50, ms":>10} {"p99, ms":>10} {"max, ms":>10} {"reordered":>10} '
+        f'{"private p99, ms":>16} {"interactive wait, ms":>21} {"bulk wait, ms":>14}'
+    )
+    for name, queue_class in (('shared fifo', FIFOUpdateQueue), ('shared', UpdateQueue), ('sharded', ShardedUpdateQueue)):
+        result = await run_mode(queue_class, args)
+        print(
+            f'{name:>12} {result["throughput"]:>10.0f} {result["p50"]:>10.2f} '
+            f'{result["p99"]:>10.2f} {result["max"]:>10.2f} {result["reordered"]:>10} '
+            f'{result["private_p99"]:>16.2f} {result["interactive_wait"]:>21.2f} {result["bulk_wait"]:>14.2f}'
+        )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+# Compares per-update queries and latency of loading the current user for a group message:
+# the old eager loading of associations, the full ORM user and the light user.
+# Usage (from the repository root): python -m benchmarks.user_loading --users 1000 --groups 20 --updates 10000
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import event, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import selectinload, sessionmaker
+
+from tables import Base, Group, GroupUserAssociation, User
+from tgbot.db import db
+from tgbot.users import TGBotUsersMixin
+
+
+class Loader(TGBotUsersMixin):
+
+    def __init__(self):
+        self.User = User
+        self.log = logging.getLogger('benchmark')
+        super().__init__()
+
+    async def get_eager_user(self, user_id):
+        # The implementation used before associations were made explicit
+        stmt = select(User).where(User.user_id == user_id).options(
+            selectinload(User.group_associations).selectinload(GroupUserAssociation.group)
+        )
+        return (await db.execute(stmt)).scalar()
+
+
+async def fill(session, users, groups):
+    await session.execute(insert(User), [{'user_id': i} for i in range(1, users+1)])
+    await session.execute(insert(Group), [{'group_id': -i} for i in range(1, groups+1)])
+    await session.execute(insert(GroupUserAssociation), [
+        {'user_id': user, 'group_id': group}
+        for user in range(1, users+1)
+        for group in random.sample(range(1, groups+1), random.randint(1, groups))
+    ])
+    await session.commit()
+
+
+async def measure(session_factory, counter, load, user_ids):
+    counter[0] = 0
+    start = time.perf_counter()
+    for user_id in user_ids:
+        db.set_context_var_value(session_factory())
+        try:
+            await load(user_id)
+            await db.commit()
+        finally:
+            await db.close()
+    elapsed = time.perf_counter() - start
+    return counter[0] / len(user_ids), elapsed / len(user_ids) * 1000
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--updates', type=int, default=10000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_async_engine(f'sqlite+aiosqlite:///{os.path.join(directory, "users.sqlite3")}')
+        counter = [0]
+        def count_query(*args):
+            counter[0] += 1
+        event.listen(engine.sync_engine, 'before_cursor_execute', count_query)
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        session_factory = sessionmaker(engine, AsyncSession, expire_on_commit=False)
+        async with session_factory() as session:
+            await fill(session, args.users, args.groups)
+        user_ids = [random.randint(1, args.users) for _ in range(args.updates)]
+        loader = Loader()
+        modes = {
+            'eager associations': loader.get_eager_user,
+            'full user': loader.get_or_create_user,
+            'light user': loader.get_or_create_light_user,
+        }
+        print(f'{"mode":>20} {"queries/update":>16} {"ms/update":>10}')
+        for name, load in modes.items():
+            # Warm up the identity cache, as in a long running bot
+            loader.user_cache.clear()
+            await measure(session_factory, counter, load, range(1, args.users+1))
+            queries, latency = await measure(session_factory, counter, load, user_ids)
+            print(f'{name:>20} {queries:>16.2f} {latency:>10.3f}')
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import asyncio
+from dataclasses import dataclass
 import datetime
 import os
 import random
@@ -7,13 +8,16 @@ import string
 import time
 
 import pyrogram
-from pyrogram import filters
-from pyrogram.enums import ChatMemberStatus
+from pyrogram import filters, raw, utils
+from pyrogram.enums import ChatMemberStatus, ChatType
+import sqlalchemy
 from sqlalchemy import func, select
+from sqlalchemy.orm import selectinload
 
 from enums import EventType, UserRole
 from gui.admin import AdminWindow
 from gui.settings import SettingsWindow
+from stats import EventWriter, compact_events
 from tables import (
     Event,
     Group,
@@ -26,6 +30,7 @@ from tgbot.db import db
 from tgbot.group_manager import group_manager
 from tgbot.handler_decorators import on_message
 from tgbot.helpers import ContextVarWrapper
+from tgbot.helpers.lru_cache import LRUCache
 from tgbot.users import current_user
 from tgbot.enums import Category
 
@@ -34,20 +39,109 @@ group_manager.add_right_group('reset_group_context')
 group_manager.add_left_group('start_in_group')
 
 current_group = ContextVarWrapper('current_group')
+EVENT_RETENTION_CHECK_INTERVAL = 60*60
+GROUP_CACHE_SIZE = 10000
+UNBOUND_CHAT_CACHE_SIZE = 10000
+UNBOUND_CHAT_CACHE_TTL = 10*60
+
+
+@dataclass(frozen=True)
+class GroupInfo:
+    # Settings of the group needed by the update handlers, the Group row itself is loaded only when it is modified
+    id: int
+    group_id: int
+    remove_joins: bool
+    remove_leaves: bool
 
 
 class Controller(BotController):
     def __init__(self):
-        super().__init__(bot_name='cm_assistant', user_table=User)
+        super().__init__(bot_name='cm_assistant', user_table=User, sharded_updates=True)
+        self.event_writer = self.add_batch_writer(Event, writer_class=EventWriter)
+        event_retention_days = os.getenv('EVENT_RETENTION_DAYS')
+        self.event_retention_days = int(event_retention_days) if event_retention_days else None
+        # Telegram chat id -> GroupInfo
+        self.group_cache = LRUCache(GROUP_CACHE_SIZE)
+        # Chat ids of groups known to be not bound
+        self.unbound_chat_cache = LRUCache(UNBOUND_CHAT_CACHE_SIZE, ttl=UNBOUND_CHAT_CACHE_TTL)
+
+    async def initialize(self):
+        await super().initialize()
+        self.add_task(self.event_retention_worker)
+
+    async def event_retention_worker(self):
+        while True:
+            try:
+                deleted = await compact_events(self.session, self.event_retention_days)
+                for group_id, count in deleted.items():
+                    self.log.info(f'Удалено {count} устаревших событий группы {group_id}')
+            except Exception:
+                self.log.exception('Не удалось удалить устаревшие события:')
+            await asyncio.sleep(EVENT_RETENTION_CHECK_INTERVAL)
+
+    def use_light_user(self, update):
+        # Group updates only need to know who the user is
+        return isinstance(update, pyrogram.types.Message) and update.chat is not None and update.chat.type in (
+            ChatType.GROUP,
+            ChatType.SUPERGROUP,
+        )
+
+    def shed_update(self, packet):
+        # While overloaded, plain messages of bound groups are only counted, straight into the event writer.
+        # Service messages (joins and leaves) and commands still go through the handlers.
+        update = packet[0]
+        if not isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return False
+        message = update.message
+        if not isinstance(message, raw.types.Message) or message.message.startswith('/'):
+            return False
+        if not isinstance(message.from_id, raw.types.PeerUser):
+            return False
+        group = self.group_cache.get(utils.get_peer_id(message.peer_id))
+        if group is None:
+            return False
+        added = self.event_writer.add_nowait({
+            'group_id': group.id,
+            'user_id': message.from_id.user_id,
+            'time': message.date,
+            'type': EventType.MESSAGE,
+        })
+        self.count_degradation('coalesced_messages' if added else 'dropped_messages')
+        return True
+
+    def get_global_filter(self):
+        async def skip_unbound_chats(flt, client, message):
+            return message.chat is None or message.chat.id not in self.unbound_chat_cache
+        # Unbound groups do not need a session, a user and a group lookup, only /start can bind them
+        return filters.create(skip_unbound_chats) | filters.command('start')
+
+    def invalidate_group_cache(self, chat_id):
+        self.group_cache.pop(chat_id)
+        self.unbound_chat_cache.pop(chat_id)
+        # Concurrent updates may put the old data back before the changes are committed
+        def after_commit(session):
+            self.group_cache.pop(chat_id)
+            self.unbound_chat_cache.pop(chat_id)
+        sqlalchemy.event.listen(db.sync_session, 'after_commit', after_commit, once=True)
 
     @on_message(filters.group, category=Category.INITIALIZE, group=group_manager.LOAD_GROUP)
     async def load_group_handler(self, message):
-        stmt = select(Group).where(
-            Group.group_id == message.chat.id
-        )
-        group = (await db.execute(stmt)).scalar()
-        if not group:
-            return
+        group = self.group_cache.get(message.chat.id)
+        if group is None:
+            stmt = select(
+                Group.id,
+                Group.group_id,
+                Group.remove_joins,
+                Group.remove_leaves,
+            ).where(
+                Group.group_id == message.chat.id
+            )
+            row = (await db.execute(stmt)).first()
+            if not row:
+                self.unbound_chat_cache.set(message.chat.id, True)
+                return
+            group = GroupInfo(**row._mapping)
+            self.group_cache.set(message.chat.id, group)
         current_group.set_context_var_value(group)
 
     @on_message(filters.group, category=Category.FINALIZE, group=group_manager.RESET_GROUP_CONTEXT)
@@ -87,7 +181,7 @@ class Controller(BotController):
         group_bind_code = message.command[1] if len(message.command) > 1 else None
         if group_bind_code:
             self.log.info('Выполняется получение пользователя из базы по переданному коду')
-            stmt = select(User).where(User.group_bind_code == group_bind_code)
+            stmt = select(User).where(User.group_bind_code == group_bind_code).options(selectinload(User.group_associations))
             user = (await db.execute(stmt)).scalar()
             self.log.info(f'Пользователь{" " if user else " не "}был получен')
         else:
@@ -120,12 +214,15 @@ class Controller(BotController):
                 await message.chat.leave()
                 return
             self.log.info('Производится создание инстанса группы и привязка пользователя к ней')
-            group = Group(group_id=message.chat.id)
+            group = Group(group_id=message.chat.id, remove_joins=False, remove_leaves=False)
             association = GroupUserAssociation(group=group, user=user, role=UserRole.ADMIN)
             db.add(group)
             db.add(association)
             user.group_bind_code = None
-            current_group.set_context_var_value(group)
+            # The primary key is needed by the handlers of this update
+            await db.flush()
+            current_group.set_context_var_value(GroupInfo(group.id, group.group_id, group.remove_joins, group.remove_leaves))
+            self.invalidate_group_cache(message.chat.id)
             await self.send_message('Привязка выполнена, теперь вы можете использовать команду /admin для настройки.', user.user_id)
             username = user.pyrogram_user.full_name if hasattr(user, 'pyrogram_user') else 'анонимный пользователь'
             self.log.info(f'Бот ассоциирован с группой. Группа: {message.chat.title}, администратор: {username}')
@@ -144,17 +241,17 @@ class Controller(BotController):
                 self.log.info('Пользователь не является администратором группы')
                 await self.send_message('Роль админа таким способом может получить только администратор группы.', chat_id=message.chat.id, blocking=True)
                 return
-            db.add(current_group)
-            if current_group not in user.groups:
+            group = await db.get(Group, current_group.id)
+            if group not in user.groups:
                 self.log.info('Пользователь не связан с группой, выполняется создание объекта привязки')
-                association = GroupUserAssociation(group=current_group, user=user)
+                association = GroupUserAssociation(group=group, user=user)
                 db.add(association)
                 self.log.info('Объект привязки создан')
             else:
                 self.log.info('Пользователь связан с группой, производится поиск объекта привязки')
                 association  = None
                 for a in user.group_associations:
-                    if a.group == current_group:
+                    if a.group == group:
                         association = a
                         self.log.info('Объект привязки найден')
                         break
@@ -172,18 +269,15 @@ class Controller(BotController):
         if not current_group.is_set:
             self.log.info('Группа неизвестна, обработка не будет произведена')
             return
-        events = []
         timestamp = int(time.time())
         for member in message.new_chat_members:
-            event = Event(
-                group=current_group,
-                user_id=member.id,
-                time=timestamp,
-                type=EventType.JOIN
-            )
-            events.append(event)
-        db.add_all(events)
-        self.log.info(f'Добавлено {len(events)} участников')
+            await self.event_writer.add({
+                'group_id': current_group.id,
+                'user_id': member.id,
+                'time': timestamp,
+                'type': EventType.JOIN,
+            })
+        self.log.info(f'Добавлено {len(message.new_chat_members)} участников')
         if current_group.remove_joins:
             self.log.info('Будет выполнена попытка удалить сервисное сообщение о добавлении участников')
             try:
@@ -198,13 +292,12 @@ class Controller(BotController):
         if not current_group.is_set:
             self.log.info('Группа неизвестна, обработка не будет произведена')
             return
-        event = Event(
-            group=current_group,
-            time=int(time.time()),
-            type=EventType.LEAVE,
-            user_id=message.left_chat_member.id
-        )
-        db.add(event)
+        await self.event_writer.add({
+            'group_id': current_group.id,
+            'user_id': message.left_chat_member.id,
+            'time': int(time.time()),
+            'type': EventType.LEAVE,
+        })
         if current_group.remove_leaves:
             self.log.info('Будет выполнена попытка удалить сервисное сообщение о выходе участника')
             try:
@@ -217,12 +310,12 @@ class Controller(BotController):
     async def group_message_handler(self, message):
         if not current_group.is_set or not current_user.is_set:
             return
-        db.add(Event(
-            group=current_group,
-            user_id=current_user.user_id,
-            time=int(time.time()),
-            type=EventType.MESSAGE
-        ))
+        await self.event_writer.add({
+            'group_id': current_group.id,
+            'user_id': current_user.user_id,
+            'time': int(time.time()),
+            'type': EventType.MESSAGE,
+        })
         self.log.info('Зарегистрировано сообщение')
 
 
@@ -0,0 +1,91 @@
+import csv
+import datetime
+import gzip
+import io
+import os
+import tempfile
+
+from sqlalchemy import and_, or_, select
+
+from tables import Event
+from tgbot.db import db, with_db
+
+EXPORT_CHUNK_SIZE = 10000
+EXPORT_COLUMNS = ['id', 'time', 'date_time', 'user_id', 'type']
+# Telegram does not accept bigger documents from bots
+EXPORT_MAX_FILE_SIZE = 50 * 1024**2
+
+
+async def iter_event_chunks(session, group_id, start_timestamp, end_timestamp, chunk_size=EXPORT_CHUNK_SIZE):
+    # Keyset pagination over (time, id): every chunk is a cheap index range scan,
+    # and only plain rows (not ORM objects) of the current chunk are kept in memory
+    last_time = last_id = None
+    while True:
+        stmt = select(Event.id, Event.time, Event.user_id, Event.type).where(
+            Event.group_id == group_id,
+            Event.time <= end_timestamp,
+        )
+        if last_time is None:
+            stmt = stmt.where(Event.time >= start_timestamp)
+        else:
+            stmt = stmt.where(or_(
+                Event.time > last_time,
+                and_(Event.time == last_time, Event.id > last_id),
+            ))
+        stmt = stmt.order_by(Event.time, Event.id).limit(chunk_size)
+        rows = (await session.execute(stmt)).all()
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            break
+        last_time, last_id = rows[-1].time, rows[-1].id
+
+
+async def write_events_csv(session, file, group_id, start_timestamp, end_timestamp, chunk_size=EXPORT_CHUNK_SIZE):
+    count = 0
+    with gzip.GzipFile(fileobj=file, mode='wb') as gzip_file, io.TextIOWrapper(gzip_file, encoding='utf-8', newline='') as text_file:
+        writer = csv.writer(text_file)
+        writer.writerow(EXPORT_COLUMNS)
+        async for rows in iter_event_chunks(session, group_id, start_timestamp, end_timestamp, chunk_size):
+            writer.writerows((
+                row.id,
+                row.time,
+                datetime.datetime.fromtimestamp(row.time, datetime.timezone.utc).isoformat(),
+                row.user_id,
+                row.type.name.lower(),
+            ) for row in rows)
+            count += len(rows)
+    return count
+
+
+@with_db()
+async def export_events(controller, chat_id, group_id, start_date_time, end_date_time, compacted_until=None):
+    # Runs in a background task, so the admin is told about a failure here
+    try:
+        await send_events(controller, chat_id, group_id, start_date_time, end_date_time, compacted_until)
+    except Exception:
+        controller.log.exception(f'Не удалось выгрузить события группы {group_id}:')
+        controller.send_message_sync('Не удалось выгрузить события, попробуйте позже.', chat_id=chat_id)
+
+
+async def send_events(controller, chat_id, group_id, start_date_time, end_date_time, compacted_until=None):
+    file_name = f'events_{group_id}_{start_date_time:%Y%m%d%H%M}_{end_date_time:%Y%m%d%H%M}.csv.gz'
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, file_name)
+        with open(path, 'wb') as file:
+            count = await write_events_csv(db, file, group_id, start_date_time.timestamp(), end_date_time.timestamp())
+        size = os.path.getsize(path)
+        controller.log.info(f'Выгружено {count} событий группы {group_id} ({size} байт)')
+        if size > EXPORT_MAX_FILE_SIZE:
+            controller.send_message_sync(
+                f'Файл выгрузки ({size / 1024**2:.1f} МБ) больше {EXPORT_MAX_FILE_SIZE // 1024**2} МБ, '
+                'которые telegram позволяет отправить боту, выберите более короткий период.',
+                chat_id=chat_id
+            )
+            return
+        caption = f'События с {start_date_time} по {end_date_time}: {count}.'
+        if compacted_until is not None and start_date_time.timestamp() < compacted_until:
+            caption += '\nСобытия до {} удалены по сроку хранения и в выгрузку не попали.'.format(
+                datetime.datetime.fromtimestamp(compacted_until)
+            )
+        await controller.app.send_document(chat_id, path, caption=caption)
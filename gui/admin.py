@@ -9,13 +9,13 @@ from tgbot.gui import InputField, Window
 from tgbot.gui.buttons import CheckBoxButton, SimpleButton
 from tgbot.gui.keyboards import GridKeyboard
 from tgbot.gui.tabs.mixins import DateTimeSelectionTabMixin
-from tgbot.users import current_user
 from enums import EventType, GroupStatsDateTimeRangeSelectionScreen, UserRole
+from export import export_events
 from gui.mixins import GroupSelectionTabMixin, GroupTabMixin
 from gui.tabs import GroupTab
+from stats import count_active_users, get_group_stats
 import tables
 from tables import (
-    Event,
     Group,
     GroupUserAssociation,
     User,
@@ -28,7 +28,7 @@ class GroupSelectionTab(GroupSelectionTabMixin):
     async def build(self, *args, **kwargs):
         await super().build(*args, **kwargs)
         groups = []
-        for association in current_user.group_associations:
+        for association in await self.get_user_associations():
             if not association.role in [UserRole.MODERATOR, UserRole.ADMIN]:
                 continue
             groups.append(association.group)
@@ -81,6 +81,7 @@ class GroupAdminSettingsTab(GroupTab):
             return
         group.remove_joins = state
         db.add(group)
+        self.window.controller.invalidate_group_cache(group.group_id)
 
     async def on_remove_leaves_cb(self, state, arg):
         group = (await self.get_association_object()).group
@@ -88,6 +89,7 @@ class GroupAdminSettingsTab(GroupTab):
             return
         group.remove_leaves = state
         db.add(group)
+        self.window.controller.invalidate_group_cache(group.group_id)
 
     async def on_stats_btn(self, arg):
         await self.custom_switch_tab(GroupStatsDateTimeRangeSelectionTab)
@@ -161,6 +163,10 @@ class GroupStatsTab(GroupTabMixin):
             'Обновить',
             callback=self.on_update_btn
         ))
+        self.keyboard.add_button(SimpleButton(
+            'Выгрузить события',
+            callback=self.on_export_btn
+        ))
         self.keyboard.add_row(SimpleButton(
             'Назад',
             callback=self.on_back_btn
@@ -170,36 +176,42 @@ class GroupStatsTab(GroupTabMixin):
         update_time = datetime.datetime.now().strftime('%H:%M:%S')
         self.text.set_header(f'Обновлено в {update_time}.')
 
+    async def on_export_btn(self, arg):
+        group = (await self.get_association_object()).group
+        # The export may take a while, so it runs in its own task with its own session
+        self.window.controller.add_task(
+            export_events,
+            self.window.controller,
+            self.window.chat_id,
+            group.id,
+            self.row.start_date_time,
+            self.row.end_date_time,
+            compacted_until=group.events_compacted_until,
+            name=f'export_events_{group.id}',
+        )
+        self.text.set_header('Выгрузка началась, файл будет отправлен в этот чат.')
+
     async def on_back_btn(self, arg):
         await self.custom_switch_tab(GroupStatsDateTimeRangeSelectionTab)
 
     async def get_text_data(self):
         group = (await self.get_association_object()).group
-        start_timestamp = self.row.start_date_time.timestamp()
-        end_timestamp = self.row.end_date_time.timestamp()
-        stmt = select(Event).where(
-            Event.time >= start_timestamp,
-            Event.time <= end_timestamp,
-            Event.group_id == group.id,
+        args = (
+            db,
+            group.id,
+            self.row.start_date_time.timestamp(),
+            self.row.end_date_time.timestamp(),
         )
-        events = (await db.execute(stmt)).scalars()
-        joins = 0
-        leaves = 0
-        messages = 0
-        for event in events:
-            if event.type == EventType.JOIN:
-                joins += 1
-            elif event.type == EventType.LEAVE:
-                leaves += 1
-            else:
-                messages += 1
+        counts = await get_group_stats(*args, compacted_until=group.events_compacted_until)
+        active_users = await count_active_users(*args, compacted_until=group.events_compacted_until)
         return {
             'start_date_time': self.row.start_date_time,
             'end_date_time': self.row.end_date_time,
-            'joins': joins,
-            'leaves': leaves,
-            'messages': messages,
-            'group_name': (await self.window.controller.app.get_chat((await self.get_association_object()).group.group_id)).title,
+            'joins': counts[EventType.JOIN],
+            'leaves': counts[EventType.LEAVE],
+            'messages': counts[EventType.MESSAGE],
+            'active_users': active_users,
+            'group_name': (await self.window.controller.app.get_chat(group.group_id)).title,
         }
 
 
@@ -314,11 +326,11 @@ class GroupAddStaffTab(GroupTabMixin):
             self.text.set_header('Пользователь не найден.')
             return
         user = await self.window.controller.get_or_create_user(user.id)
-        association = None
-        for a in user.group_associations:
-            if a.group_id == self.row.group_id:
-                association = a
-                break
+        stmt = select(GroupUserAssociation).where(
+            GroupUserAssociation.group_id == self.row.group_id,
+            GroupUserAssociation.user_id == user.id
+        )
+        association = (await db.execute(stmt)).scalar()
         if not association:
             stmt = select(Group).where(Group.id == self.row.group_id)
             group = (await db.execute(stmt)).scalar()
@@ -13,6 +13,12 @@ class GroupSelectionTabMixin(Tab):
     def get_keyboard(self):
         return GridKeyboard(self, width=1)
 
+    async def get_user_associations(self):
+        stmt = select(GroupUserAssociation).where(
+            GroupUserAssociation.user_id == current_user.id
+        )
+        return (await db.execute(stmt)).scalars().all()
+
     async def set_groups(self, groups, callback):
         for group in groups:
             group_title = (await self.window.controller.app.get_chat(group.group_id)).title
@@ -5,7 +5,6 @@ from tgbot.db import db
 from tgbot.gui import Window
 from tgbot.gui.buttons import CheckBoxButton, SimpleButton
 from tgbot.gui.keyboards import GridKeyboard
-from tgbot.users import current_user
 from gui.mixins import GroupSelectionTabMixin
 from gui.tabs import GroupTab
 import tables
@@ -20,11 +19,12 @@ class GroupSelectionTab(GroupSelectionTabMixin):
 
     async def build(self, *args, **kwargs):
         await super().build(*args, **kwargs)
-        if not current_user.groups:
+        groups = [association.group for association in await self.get_user_associations()]
+        if not groups:
             self.text.set_body('Вы не состоите ни в одной из групп, к которым я привязан.')
             return
         self.text.set_body('Выберите группу.')
-        await self.set_groups(current_user.groups, callback=self.on_group_btn)
+        await self.set_groups(groups, callback=self.on_group_btn)
 
     async def on_group_btn(self, arg):
         await self.window.switch_tab(GroupSettingsTab, group_id=arg)
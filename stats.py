@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+from collections import defaultdict
+import math
+import os
+import time
+
+import dotenv
+from sqlalchemy import delete, func, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from enums import EventType
+from tables import Event, Group, GroupDailyActiveUsers, GroupDailyStats, GroupHourlyStats
+from tgbot.batch_writer import BatchWriter
+from tgbot.db import get_upsert_insert
+from tgbot.helpers.hyperloglog import HyperLogLog
+
+HOUR = 60*60
+DAY = 24*HOUR
+ROLLUP_TABLES = {
+    GroupHourlyStats: HOUR,
+    GroupDailyStats: DAY,
+}
+COUNTER_COLUMNS = {
+    EventType.JOIN: 'joins',
+    EventType.LEAVE: 'leaves',
+    EventType.MESSAGE: 'messages',
+}
+BACKFILL_CHUNK_SIZE = 50000
+COMPACTION_BATCH_SIZE = 1000
+# Pause between deletion batches, so that the update handlers are not blocked for long
+COMPACTION_PAUSE = 0.1
+
+
+class EventWriter(BatchWriter):
+
+    async def write(self, session, rows):
+        await super().write(session, rows)
+        await update_rollups(session, rows)
+        await update_active_users(session, rows)
+
+
+async def count_events(session, group_id, start_timestamp, end_timestamp):
+    stmt = select(Event.type, func.count()).where(
+        Event.group_id == group_id,
+        Event.time >= start_timestamp,
+        Event.time <= end_timestamp,
+    ).group_by(Event.type)
+    counts = dict((await session.execute(stmt)).all())
+    return {event_type: counts.get(event_type, 0) for event_type in EventType}
+
+
+def get_counters(rows, bucket_size):
+    counters = defaultdict(lambda: dict.fromkeys(COUNTER_COLUMNS.values(), 0))
+    for row in rows:
+        bucket = row['time'] // bucket_size * bucket_size
+        counters[(row['group_id'], bucket)][COUNTER_COLUMNS[row['type']]] += 1
+    return counters
+
+
+async def add_to_rollups(session, table, counters):
+    if not counters:
+        return
+    stmt = get_upsert_insert(session, table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['group_id', 'bucket'],
+        set_={
+            column: getattr(table, column) + getattr(stmt.excluded, column)
+            for column in COUNTER_COLUMNS.values()
+        }
+    )
+    await session.execute(stmt, [
+        {'group_id': group_id, 'bucket': bucket, **values}
+        for (group_id, bucket), values in counters.items()
+    ])
+
+
+async def update_rollups(session, rows):
+    for table, bucket_size in ROLLUP_TABLES.items():
+        await add_to_rollups(session, table, get_counters(rows, bucket_size))
+
+
+async def update_active_users(session, rows):
+    user_ids = defaultdict(set)
+    for row in rows:
+        if row['type'] == EventType.MESSAGE:
+            user_ids[(row['group_id'], row['time'] // DAY * DAY)].add(row['user_id'])
+    if not user_ids:
+        return
+    stmt = select(GroupDailyActiveUsers).where(
+        tuple_(GroupDailyActiveUsers.group_id, GroupDailyActiveUsers.bucket).in_(list(user_ids))
+    )
+    sketch_rows = {(r.group_id, r.bucket): r for r in (await session.execute(stmt)).scalars()}
+    for (group_id, bucket), ids in user_ids.items():
+        sketch_row = sketch_rows.get((group_id, bucket))
+        if sketch_row is None:
+            sketch = HyperLogLog()
+            sketch_row = GroupDailyActiveUsers(group_id=group_id, bucket=bucket)
+            session.add(sketch_row)
+        else:
+            sketch = HyperLogLog.from_bytes(sketch_row.registers)
+        sketch.update(ids)
+        sketch_row.registers = sketch.to_bytes()
+
+
+def get_whole_buckets(start, end, bucket_size):
+    # Returns the range of whole buckets within [start, end), or None
+    first = -(-start // bucket_size) * bucket_size
+    last = end // bucket_size * bucket_size
+    if first >= last:
+        return None
+    return first, last
+
+
+async def sum_rollups(session, table, group_id, start, end):
+    stmt = select(*[
+        func.coalesce(func.sum(getattr(table, column)), 0)
+        for column in COUNTER_COLUMNS.values()
+    ]).where(
+        table.group_id == group_id,
+        table.bucket >= start,
+        table.bucket < end,
+    )
+    sums = (await session.execute(stmt)).one()
+    return dict(zip(COUNTER_COLUMNS, sums))
+
+
+async def get_group_stats(session, group_id, start_timestamp, end_timestamp, compacted_until=None):
+    # Whole days and hours are taken from the rollups, and only the partial edge hours from the event table,
+    # so the cost of the query does not depend on the length of the range.
+    start = math.ceil(start_timestamp)
+    end = math.floor(end_timestamp) + 1
+    if compacted_until:
+        # Events of this period are deleted, the edges are expanded to whole hours
+        if start < compacted_until:
+            start = start // HOUR * HOUR
+        if end < compacted_until:
+            end = -(-end // HOUR) * HOUR
+    counts = dict.fromkeys(EventType, 0)
+    if start >= end:
+        return counts
+    parts = []
+    days = get_whole_buckets(start, end, DAY)
+    if days:
+        parts.append((GroupDailyStats, *days))
+        remaining_ranges = [(start, days[0]), (days[1], end)]
+    else:
+        remaining_ranges = [(start, end)]
+    for range_start, range_end in remaining_ranges:
+        if range_start >= range_end:
+            continue
+        hours = get_whole_buckets(range_start, range_end, HOUR)
+        if not hours:
+            parts.append((Event, range_start, range_end))
+            continue
+        parts.append((GroupHourlyStats, *hours))
+        parts.append((Event, range_start, hours[0]))
+        parts.append((Event, hours[1], range_end))
+    for table, part_start, part_end in parts:
+        if part_start >= part_end:
+            continue
+        if table is Event:
+            part_counts = await count_events(session, group_id, part_start, part_end-1)
+        else:
+            part_counts = await sum_rollups(session, table, group_id, part_start, part_end)
+        for event_type, count in part_counts.items():
+            counts[event_type] += count
+    return counts
+
+
+async def count_active_users(session, group_id, start_timestamp, end_timestamp, compacted_until=None):
+    # Whole days are taken from the daily sketches, and the edges from the event table
+    start = math.ceil(start_timestamp)
+    end = math.floor(end_timestamp) + 1
+    compacted_until = compacted_until or 0
+    sketch = HyperLogLog()
+    if start >= end:
+        return 0
+    sketch_ranges = []
+    event_ranges = []
+    days = get_whole_buckets(start, end, DAY)
+    if days:
+        sketch_ranges.append(days)
+        edges = [(start, days[0]), (days[1], end)]
+    else:
+        edges = [(start, end)]
+    for edge_start, edge_end in edges:
+        if edge_start >= edge_end:
+            continue
+        if edge_start < compacted_until:
+            # There are no events for this period, the whole day sketches are used instead
+            sketch_ranges.append((edge_start // DAY * DAY, min(edge_end, compacted_until)))
+            edge_start = compacted_until
+        if edge_start < edge_end:
+            event_ranges.append((edge_start, edge_end))
+    for range_start, range_end in sketch_ranges:
+        stmt = select(GroupDailyActiveUsers.registers).where(
+            GroupDailyActiveUsers.group_id == group_id,
+            GroupDailyActiveUsers.bucket >= range_start,
+            GroupDailyActiveUsers.bucket < range_end,
+        )
+        sketch.merge(*[HyperLogLog.from_bytes(r) for r in (await session.execute(stmt)).scalars()])
+    for range_start, range_end in event_ranges:
+        stmt = select(Event.user_id).distinct().where(
+            Event.group_id == group_id,
+            Event.type == EventType.MESSAGE,
+            Event.time >= range_start,
+            Event.time < range_end,
+        )
+        sketch.update((await session.execute(stmt)).scalars())
+    return sketch.count()
+
+
+async def backfill_rollups(session_factory, chunk_size=BACKFILL_CHUNK_SIZE):
+    # Rebuilds the rollups from the event table, the bot should be stopped while this runs.
+    # The hourly rollups and sketches of the compacted periods are kept, as there are no events for them anymore.
+    async with session_factory() as session:
+        max_id = (await session.execute(select(func.max(Event.id)))).scalar() or 0
+        stmt = select(Group.id, Group.events_compacted_until)
+        watermarks = {group_id: compacted_until or 0 for group_id, compacted_until in (await session.execute(stmt)).all()}
+        for table in [*ROLLUP_TABLES, GroupDailyActiveUsers]:
+            await session.execute(delete(table).where(table.group_id.notin_(watermarks)))
+        for group_id, compacted_until in watermarks.items():
+            await session.execute(delete(GroupHourlyStats).where(
+                GroupHourlyStats.group_id == group_id,
+                GroupHourlyStats.bucket >= compacted_until,
+            ))
+            await session.execute(delete(GroupDailyStats).where(
+                GroupDailyStats.group_id == group_id,
+                GroupDailyStats.bucket >= compacted_until // DAY * DAY,
+            ))
+            # Sketches can not be split by hours, so only the days without compacted hours are rebuilt
+            await session.execute(delete(GroupDailyActiveUsers).where(
+                GroupDailyActiveUsers.group_id == group_id,
+                GroupDailyActiveUsers.bucket >= -(-compacted_until // DAY) * DAY,
+            ))
+        await session.commit()
+    for chunk_start in range(0, max_id, chunk_size):
+        async with session_factory() as session:
+            stmt = select(Event.group_id, Event.user_id, Event.time, Event.type).where(
+                Event.id > chunk_start,
+                Event.id <= chunk_start + chunk_size,
+            )
+            rows = [
+                row for row in (await session.execute(stmt)).mappings()
+                if row['time'] >= watermarks.get(row['group_id'], 0)
+            ]
+            await add_to_rollups(session, GroupHourlyStats, get_counters(rows, HOUR))
+            await update_active_users(session, [
+                row for row in rows
+                if row['time'] >= -(-watermarks.get(row['group_id'], 0) // DAY) * DAY
+            ])
+            await session.commit()
+        print(f'Обработано событий: {min(chunk_start + chunk_size, max_id)} из {max_id} (по id)')
+    # Days are built from the hours, because a day can contain both compacted and not compacted hours
+    for group_id, compacted_until in watermarks.items():
+        async with session_factory() as session:
+            stmt = select(GroupHourlyStats).where(
+                GroupHourlyStats.group_id == group_id,
+                GroupHourlyStats.bucket >= compacted_until // DAY * DAY,
+            )
+            counters = defaultdict(lambda: dict.fromkeys(COUNTER_COLUMNS.values(), 0))
+            for hour in (await session.execute(stmt)).scalars():
+                values = counters[(group_id, hour.bucket // DAY * DAY)]
+                for column in COUNTER_COLUMNS.values():
+                    values[column] += getattr(hour, column)
+            await add_to_rollups(session, GroupDailyStats, counters)
+            await session.commit()
+
+
+async def compact_group_events(session_factory, group_id, cutoff, batch_size=COMPACTION_BATCH_SIZE, pause=COMPACTION_PAUSE):
+    # The events are already counted in the rollups, so they only need to be deleted.
+    # The watermark is moved first, so that the statistics do not use partially deleted hours.
+    async with session_factory() as session:
+        await session.execute(update(Group).where(Group.id == group_id).values(events_compacted_until=cutoff))
+        await session.commit()
+    deleted = 0
+    while True:
+        async with session_factory() as session:
+            ids_stmt = select(Event.id).where(
+                Event.group_id == group_id,
+                Event.time < cutoff,
+            ).limit(batch_size)
+            stmt = delete(Event).where(Event.id.in_(ids_stmt)).execution_options(synchronize_session=False)
+            result = await session.execute(stmt)
+            await session.commit()
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
+        await asyncio.sleep(pause)
+
+
+async def compact_events(session_factory, default_retention_days=None, **kwargs):
+    async with session_factory() as session:
+        stmt = select(Group.id, Group.event_retention_days, Group.events_compacted_until)
+        groups = (await session.execute(stmt)).all()
+    now = int(time.time())
+    deleted = {}
+    for group_id, retention_days, compacted_until in groups:
+        retention_days = retention_days or default_retention_days
+        if not retention_days:
+            continue
+        cutoff = (now - retention_days*DAY) // HOUR * HOUR
+        if compacted_until and cutoff <= compacted_until:
+            continue
+        deleted[group_id] = await compact_group_events(session_factory, group_id, cutoff, **kwargs)
+    return deleted
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Обслуживание статистики групп')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subparsers.add_parser('backfill', help='Перестроить агрегированную статистику и скетчи активных пользователей по таблице событий')
+    backfill_parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE)
+    args = parser.parse_args()
+    dotenv.load_dotenv()
+    engine = create_async_engine(os.environ['DB_URL'])
+    session_factory = sessionmaker(engine, AsyncSession, expire_on_commit=False)
+    try:
+        if args.command == 'backfill':
+            await backfill_rollups(session_factory, args.chunk_size)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,8 +1,8 @@
 import enums
 
-from sqlalchemy import Boolean, Column, DateTime, Enum, ForeignKey, Integer, String
+from sqlalchemy import Boolean, Column, DateTime, Enum, ForeignKey, Index, Integer, LargeBinary, PrimaryKeyConstraint, String
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy.orm import backref, declarative_mixin, relationship
+from sqlalchemy.orm import backref, declarative_mixin, declared_attr, relationship
 
 from tgbot.db.tables import Base, User
 from tgbot.gui.mixins import ButtonMixin, TabMixin
@@ -11,7 +11,8 @@ from tgbot.gui.mixins import ButtonMixin, TabMixin
 class User(User):
     group_bind_code = Column(String)
     groups = association_proxy('group_associations', 'group')
-    group_associations = relationship('GroupUserAssociation', back_populates='user', lazy='selectin')
+    # Not needed by most updates, load explicitly (e.g. with selectinload) where required
+    group_associations = relationship('GroupUserAssociation', back_populates='user', lazy='raise')
 
 
 class Group(Base):
@@ -20,6 +21,10 @@ class Group(Base):
     group_id = Column(Integer, nullable=False)
     remove_joins = Column(Boolean, default=False)
     remove_leaves = Column(Boolean, default=False)
+    # If not set, EVENT_RETENTION_DAYS environment variable is used
+    event_retention_days = Column(Integer)
+    # Events before this timestamp are deleted, and only the rollups are available for this period
+    events_compacted_until = Column(Integer)
 
 
 class GroupUserAssociation(Base):
@@ -40,6 +45,43 @@ class Event(Base):
     user_id = Column(Integer, nullable=False)
     time = Column(Integer, nullable=False)
     type = Column(Enum(enums.EventType), nullable=False)
+    __table_args__ = (
+        Index('ix_event_group_id_time_type', 'group_id', 'time', 'type'),
+    )
+
+
+@declarative_mixin
+class EventCountersMixin:
+    @declared_attr
+    def group_id(cls):
+        return Column(Integer, ForeignKey('group.id'), nullable=False)
+
+    # Timestamp of the bucket start
+    bucket = Column(Integer, nullable=False)
+    joins = Column(Integer, nullable=False, default=0)
+    leaves = Column(Integer, nullable=False, default=0)
+    messages = Column(Integer, nullable=False, default=0)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (PrimaryKeyConstraint('group_id', 'bucket'),)
+
+
+class GroupHourlyStats(EventCountersMixin, Base):
+    __tablename__ = 'group_hourly_stats'
+
+
+class GroupDailyStats(EventCountersMixin, Base):
+    __tablename__ = 'group_daily_stats'
+
+
+class GroupDailyActiveUsers(Base):
+    __tablename__ = 'group_daily_active_users'
+    group_id = Column(Integer, ForeignKey('group.id'), primary_key=True)
+    # Timestamp of the day start
+    bucket = Column(Integer, primary_key=True)
+    # HyperLogLog registers of the ids of users who wrote messages
+    registers = Column(LargeBinary, nullable=False)
 
 
 class GroupTabMixin(TabMixin):
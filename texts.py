@@ -18,6 +18,7 @@ STATS_TEXT = (
     'Статистика с {start_date_time} по {end_date_time}.\n'
     'Новых пользователей: {joins}.\n'
     'Вышедших пользователей: {leaves}.\n'
-    'Написано сообщений: {messages}.'
+    'Написано сообщений: {messages}.\n'
+    'Активных пользователей (приблизительно): {active_users}.'
 )
 
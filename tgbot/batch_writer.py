@@ -0,0 +1,109 @@
+import asyncio
+
+from sqlalchemy import insert
+
+
+# Pause before the first retry of a failed batch in seconds, doubled after every failure
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+
+class BatchWriter:
+
+    def __init__(self, controller, table, max_batch_size=500, max_delay=1, max_queue_size=10000, max_attempts=10, name=None):
+        self.controller = controller
+        self.table = table
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        # A batch that failed this many times in a row is dropped, so that a bad row can not stop the writer
+        self.max_attempts = max_attempts
+        self.name = name or table.__tablename__
+        self.queue = asyncio.Queue(max_queue_size)
+        # Rows taken from the queue, but not yet written to the database
+        self.rows = []
+        self.running = False
+        # Rows lost because the queue was full or the batch could not be written
+        self.dropped = 0
+        self.failed_attempts = 0
+
+    async def add(self, row):
+        if not self.running:
+            # The writer is stopped (or not yet started), rows will be written by the final flush
+            self.rows.append(row)
+            return
+        await self.queue.put(row)
+
+    def add_nowait(self, row):
+        # Returns False if the queue is full and the row is dropped
+        if not self.running:
+            self.rows.append(row)
+            return True
+        try:
+            self.queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        return True
+
+    def drain_queue(self, limit=None):
+        while not self.queue.empty() and (limit is None or len(self.rows) < limit):
+            self.rows.append(self.queue.get_nowait())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.running = True
+        try:
+            while True:
+                if not self.rows:
+                    self.rows.append(await self.queue.get())
+                deadline = loop.time() + self.max_delay
+                while len(self.rows) < self.max_batch_size:
+                    if not self.queue.empty():
+                        self.rows.append(self.queue.get_nowait())
+                        continue
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        self.rows.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                try:
+                    await self.flush()
+                    self.failed_attempts = 0
+                except Exception:
+                    await self.handle_failure()
+        finally:
+            self.running = False
+            # Unblock handlers waiting for free space in the queue
+            self.drain_queue()
+
+    async def handle_failure(self):
+        # The rows are kept and written again after a pause, new rows wait in the queue meanwhile
+        self.failed_attempts += 1
+        if self.failed_attempts >= self.max_attempts:
+            self.controller.log.exception(f'Не удалось записать {len(self.rows)} строк в таблицу {self.name} за {self.failed_attempts} попыток, строки отброшены:')
+            self.dropped += len(self.rows)
+            self.rows = []
+            self.failed_attempts = 0
+            return
+        delay = min(RETRY_DELAY * 2**(self.failed_attempts-1), MAX_RETRY_DELAY)
+        self.controller.log.exception(f'Не удалось записать {len(self.rows)} строк в таблицу {self.name}, следующая попытка через {delay} секунд:')
+        await asyncio.sleep(delay)
+
+    async def flush(self):
+        # Writes all queued rows, every transaction takes at most max_batch_size of them
+        while True:
+            self.drain_queue(self.max_batch_size)
+            if not self.rows:
+                return
+            rows = self.rows[:self.max_batch_size]
+            async with self.controller.session() as session:
+                await self.write(session, rows)
+                await session.commit()
+                # Rows are forgotten only after the commit, so that a failed or cancelled flush can be repeated
+                del self.rows[:len(rows)]
+            self.controller.log.debug(f'В таблицу {self.name} записано {len(rows)} строк')
+
+    async def write(self, session, rows):
+        await session.execute(insert(self.table), rows)
@@ -1,4 +1,6 @@
 import asyncio
+from collections import Counter
+import logging
 import os
 import signal
 import sys
@@ -19,8 +21,11 @@ from tgbot.core import TGBotCoreMixin
 from tgbot.handler_decorators import get_handlers
 from tgbot.gui import TGBotGUIMixin
 from tgbot.messages import TGBotMessagesMixin
+from tgbot.metrics import TGBotMetricsMixin
+from tgbot.update_recorder import UPDATES_RECORD_FLUSH_INTERVAL, UpdateRecorder
 from tgbot.users import TGBotUsersMixin
 from tgbot.wrappers import apply_wrappers
+from tgbot.wrappers.update_queue import ShardedUpdateQueue
 
 dotenv.load_dotenv()
 
@@ -30,10 +35,19 @@ class BotController(
     db.TGBotDBMixin,
     TGBotGUIMixin,
     TGBotMessagesMixin,
+    TGBotMetricsMixin,
     TGBotUsersMixin,
 ):
 
-    def __init__(self, bot_name, use_uvloop=False, user_table=None):
+    def __init__(
+        self,
+        bot_name,
+        use_uvloop=False,
+        user_table=None,
+        sharded_updates=False,
+        updates_high_watermark=10000,
+        updates_low_watermark=None,
+    ):
         for var in ['api_id', 'api_hash', 'bot_token', 'db_url', 'dev_ids']:
             setattr(self, var, os.getenv(var.upper()))
             if not getattr(self, var):
@@ -48,13 +62,67 @@ class BotController(
             else:
                 uvloop.install()
         self.User = user_table or db.tables.User
+        self.sharded_updates = sharded_updates
+        self.updates_high_watermark = updates_high_watermark
+        self.updates_low_watermark = updates_low_watermark
+        # Degradation name -> how many times it happened, total and during the current overload
+        self.degradations = Counter()
+        self.overload_degradations = Counter()
+        self.log_level_before_overload = None
+        # Optional, raw updates are appended to this file for later replay (see benchmarks.replay)
+        self.updates_record_path = os.getenv('UPDATES_RECORD_PATH')
         super().__init__()
 
     def get_global_filter(self):
         pass
 
+    async def update_recorder_writer(self, interval=UPDATES_RECORD_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.app.dispatcher.recorder.flush()
+            except OSError:
+                self.log.exception(f'Не удалось записать обновления в {self.updates_record_path}:')
+
+    def shed_update(self, packet):
+        # Called for bulk updates while the update queue is overloaded.
+        # Return True if the update was handled in a cheaper way (or dropped) and must not be queued.
+        return False
+
+    def count_degradation(self, name):
+        self.degradations[name] += 1
+        self.overload_degradations[name] += 1
+        if self.overload_degradations[name] == 1:
+            self.log.warning(f'Деградация из-за перегрузки: {name}')
+
+    def set_overloaded(self, overloaded, queue_size):
+        if overloaded:
+            self.overload_degradations.clear()
+            self.log.warning(f'В очереди {queue_size} обновлений, бот перегружен')
+            self.count_degradation('overload')
+            if self.log.level < logging.INFO:
+                self.log_level_before_overload = self.log.level
+                self.log.setLevel(logging.INFO)
+                self.count_degradation('debug_logging_disabled')
+            return
+        if self.log_level_before_overload is not None:
+            self.log.setLevel(self.log_level_before_overload)
+            self.log_level_before_overload = None
+        summary = ', '.join(f'{name}: {count}' for name, count in self.overload_degradations.items())
+        self.log.warning(f'В очереди {queue_size} обновлений, перегрузка закончилась ({summary})')
+
     async def initialize(self):
         self.app.controller = self
+        if self.sharded_updates:
+            self.app.dispatcher.updates_queue_class = ShardedUpdateQueue
+        self.app.dispatcher.high_watermark = self.updates_high_watermark
+        self.app.dispatcher.low_watermark = self.updates_low_watermark
+        self.app.dispatcher.overload_listener = self
+        if self.updates_record_path:
+            self.app.dispatcher.recorder = UpdateRecorder(self.updates_record_path)
+            self.log.info(f'Обновления записываются в {self.updates_record_path}')
+        if self.message_queue_path:
+            self.open_message_store()
         pyrogram.types.Message.reply = custom_methods.reply
         exception_handler.wrap_methods(self)
         global_filter = self.get_global_filter()
@@ -64,9 +132,9 @@ class BotController(
                 filters = handler['handler_args'][0]
             if 'filters' in handler['handler_kwargs']:
                 filters = handler['handler_kwargs'].pop('filters')
-            if global_filter and isinstance(handler['handler'], pyrogram.handlers.MessageHandler):
+            if global_filter and issubclass(handler['handler'], pyrogram.handlers.MessageHandler):
                 if filters is None:
-                    filters = [global_filter]
+                    filters = global_filter
                 else:
                     filters = global_filter & filters
             method = getattr(self, handler['handler_name'])
@@ -81,18 +149,18 @@ class BotController(
             asyncio.get_running_loop().add_signal_handler(signal.SIGINT, self.stop_from_signal)
         except NotImplementedError:
             signal.signal(signal.SIGINT, self.stop_from_signal)
-        self.app = pyrogram.Client(
-            'telegram_account',
-            api_id=self.api_id,
-            api_hash=self.api_hash,
-            bot_token=self.bot_token,
-            workdir='.',
-            sleep_threshold=0,
-            parse_mode=pyrogram.enums.ParseMode.HTML,
-        )
+        self.app = self.create_client()
         await self.initialize()
+        self.start_batch_writers()
         await self.app.start()
         self.add_task(self.message_sender, 23)
+        self.add_task(self.message_limiter_sweeper)
+        if self.message_store is not None:
+            self.add_task(self.message_store_writer)
+        if self.app.dispatcher.recorder is not None:
+            self.add_task(self.update_recorder_writer)
+        if self.metrics_port:
+            self.add_task(self.metrics_server)
         self.log.info('Приложение запущено')
         try:
             await self.monitor_tasks()
@@ -100,8 +168,24 @@ class BotController(
             print('\r', end='')  # To remove C character from terminal
             self.log.info('Выход')
             await self.app.stop()
+            if self.app.dispatcher.recorder is not None:
+                self.app.dispatcher.recorder.close()
+            if self.message_store is not None:
+                self.close_message_store()
+            await self.flush_batch_writers()
             await self.close_db()
 
+    def create_client(self):
+        return pyrogram.Client(
+            'telegram_account',
+            api_id=self.api_id,
+            api_hash=self.api_hash,
+            bot_token=self.bot_token,
+            workdir='.',
+            sleep_threshold=0,
+            parse_mode=pyrogram.enums.ParseMode.HTML,
+        )
+
     def stop_from_signal(self, *args, **kwargs):
         self.stop()
 
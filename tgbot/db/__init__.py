@@ -3,34 +3,63 @@ from functools import wraps
 import os
 
 import sqlalchemy
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker
 
+from tgbot.batch_writer import BatchWriter
+from tgbot.db.session import LazySession, TrackedSession
 from tgbot.enums import Category
 from tgbot.group_manager import group_manager
 from tgbot.handler_decorators import on_callback_query, on_message
 from tgbot.helpers import ContextVarWrapper
 
 db = ContextVarWrapper('db')
+# Insert constructs supporting "INSERT ... ON CONFLICT"
+UPSERT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
 
 
 class TGBotDBMixin:
 
+    def __init__(self):
+        self.batch_writers = []
+        super().__init__()
+
     async def init_db(self):
         self.db_engine = create_async_engine(
             self.db_url,
         )
-        async_session = sessionmaker(self.db_engine, AsyncSession, expire_on_commit=False)
+        async_session = sessionmaker(self.db_engine, AsyncSession, expire_on_commit=False, sync_session_class=TrackedSession)
         self.session = async_session
 
     async def close_db(self):
         await self.db_engine.dispose()
 
+    def add_batch_writer(self, table, writer_class=BatchWriter, **kwargs):
+        writer = writer_class(self, table, **kwargs)
+        self.batch_writers.append(writer)
+        return writer
+
+    def start_batch_writers(self):
+        for writer in self.batch_writers:
+            self.add_task(writer.run, name=f'batch_writer_{writer.name}')
+
+    async def flush_batch_writers(self):
+        for writer in self.batch_writers:
+            try:
+                await writer.flush()
+            except Exception:
+                writer.dropped += len(writer.rows) + writer.queue.qsize()
+                self.log.exception(f'Не удалось записать {len(writer.rows) + writer.queue.qsize()} строк в таблицу {writer.name}:')
+
     @on_message(category=Category.INITIALIZE, group=group_manager.CREATE_SESSION)
     @on_callback_query(category=Category.INITIALIZE, group=group_manager.CREATE_SESSION)
     async def create_session(self, update):
-        db.set_context_var_value(self.session())
+        db.set_context_var_value(LazySession(self.session))
 
     @on_message(category=Category.RESTORE, group=group_manager.ROLLBACK_SESSION)
     @on_callback_query(category=Category.RESTORE, group=group_manager.ROLLBACK_SESSION)
@@ -45,9 +74,17 @@ class TGBotDBMixin:
     @on_message(category=Category.FINALIZE, group=group_manager.RESET_SESSION_CONTEXT)
     @on_callback_query(category=Category.FINALIZE, group=group_manager.RESET_SESSION_CONTEXT)
     async def reset_session_context(self, update):
+        await db.close()
         db.reset_context_var()
 
 
+def get_upsert_insert(session, table):
+    dialect_name = session.bind.dialect.name
+    if dialect_name not in UPSERT_INSERTS:
+        raise ValueError(f'Upsert is not supported for the {dialect_name} dialect')
+    return UPSERT_INSERTS[dialect_name](table)
+
+
 def with_db(wait_for_commit=False):
     def decorator(method):
         @wraps(method)
@@ -66,13 +103,14 @@ def with_db(wait_for_commit=False):
                     # Somewhere in another task something went wrong, we should not continue
                     return
                 await db.close()
-            db.set_context_var_value(self.session())
+            db.set_context_var_value(LazySession(self.session))
             success = False
             try:
                 result = await method(self, *args, **kwargs)
                 success = True
             finally:
                 await (db.commit() if success else db.rollback())
+                await db.close()
             return result
         return wrapper
     return decorator
@@ -0,0 +1,70 @@
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+
+class TrackedSession(Session):
+    # Knows whether anything was written in the current transaction
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.has_writes = False
+
+
+@sqlalchemy.event.listens_for(TrackedSession, 'after_flush')
+def after_flush(session, flush_context):
+    session.has_writes = True
+
+
+@sqlalchemy.event.listens_for(TrackedSession, 'do_orm_execute')
+def do_orm_execute(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.has_writes = True
+
+
+@sqlalchemy.event.listens_for(TrackedSession, 'after_commit')
+@sqlalchemy.event.listens_for(TrackedSession, 'after_rollback')
+def after_transaction(session):
+    session.has_writes = False
+
+
+class LazySession:
+    # Creates the session on first use, so updates that do not need the database cost nothing
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.session = None
+
+    @property
+    def is_open(self):
+        return self.session is not None
+
+    def __getattr__(self, name):
+        if self.session is None:
+            self.session = self.session_factory()
+        return getattr(self.session, name)
+
+    def needs_commit(self):
+        sync_session = self.session.sync_session
+        return (
+            sync_session.has_writes
+            or sync_session.new
+            or sync_session.dirty
+            or sync_session.deleted
+            # Someone waits for the commit of this session (see with_db)
+            or bool(sync_session.dispatch.after_commit.listeners)
+        )
+
+    async def commit(self):
+        if self.session is None or not self.needs_commit():
+            return
+        await self.session.commit()
+
+    async def rollback(self):
+        if self.session is None:
+            return
+        await self.session.rollback()
+
+    async def close(self):
+        if self.session is None:
+            return
+        await self.session.close()
@@ -82,4 +82,4 @@ class CheckBoxButton(CheckBoxButtonMixin, Base):
 class User(Base):
     __tablename__ = 'user'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False, index=True, unique=True)
@@ -1 +1,2 @@
 from tgbot.wrappers.dispatcher import Category
+from tgbot.wrappers.update_queue import UpdatePriority
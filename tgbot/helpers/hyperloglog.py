@@ -0,0 +1,69 @@
+import hashlib
+import math
+
+HASH_BITS = 64
+HASH_MASK = 2**HASH_BITS - 1
+
+
+def hash_value(value):
+    if isinstance(value, int):
+        # splitmix64 finalizer, unlike hash() it is stable between runs
+        value = (value + 0x9E3779B97F4A7C15) & HASH_MASK
+        value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & HASH_MASK
+        value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & HASH_MASK
+        return value ^ (value >> 31)
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+
+    def __init__(self, precision=12, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError('Precision must be between 4 and 16')
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+        if len(self.registers) != self.size:
+            raise ValueError(f'Expected {self.size} registers, got {len(self.registers)}')
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(precision=len(data).bit_length()-1, registers=data)
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    def add(self, value):
+        hash = hash_value(value)
+        index = hash >> (HASH_BITS - self.precision)
+        remaining_bits = HASH_BITS - self.precision
+        rank = remaining_bits - (hash & ((1 << remaining_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, *others):
+        for other in others:
+            if other.precision != self.precision:
+                raise ValueError('Sketches with different precision can not be merged')
+        if others:
+            self.registers = bytearray(map(max, self.registers, *[other.registers for other in others]))
+
+    def count(self):
+        if self.size >= 128:
+            alpha = 0.7213 / (1 + 1.079/self.size)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[self.size]
+        estimate = alpha * self.size**2 / math.fsum(2.0**-register for register in self.registers)
+        if estimate <= 2.5 * self.size:
+            # Linear counting is more accurate for small cardinalities
+            zeros = self.registers.count(0)
+            if zeros:
+                estimate = self.size * math.log(self.size / zeros)
+        return round(estimate)
+
+    def __len__(self):
+        return self.count()
@@ -0,0 +1,43 @@
+from collections import OrderedDict
+import time
+
+
+class LRUCache:
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        # Seconds after which an item is considered missing, None means forever
+        self.ttl = ttl
+        # key -> (expiration time, value)
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self.items[key]
+        except KeyError:
+            return default
+        if expires is not None and expires <= time.monotonic():
+            del self.items[key]
+            return default
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.items[key] = (expires, value)
+        self.items.move_to_end(key)
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, (None, default))[1]
+
+    def clear(self):
+        self.items.clear()
+
+    def __contains__(self, key):
+        missing = object()
+        return self.get(key, missing) is not missing
+
+    def __len__(self):
+        return len(self.items)
@@ -1,6 +1,9 @@
 import asyncio
 import time
 
+# How often idle limiters are looked for, in seconds
+LIMITER_SWEEP_INTERVAL = 60
+
 
 class Limiter:
     def __init__(self, controller, amount, period, static=True, name=None):
@@ -13,8 +16,12 @@ class Limiter:
         self.full_name = 'лимитер' if not self.name else 'лимитер '+self.name
         self.controller.log.debug(f'Создан {self.full_name} ({self.amount} событий за {self.period} секунд)')
 
+    def get_delay(self):
+        # Seconds until the next action would be allowed, without using it
+        return max(self.period-(time.time()-self.events[0]), 0)
+
     async def __call__(self):
-        delay = max(self.period-(time.time()-self.events[0]), 0)
+        delay = self.get_delay()
         self.controller.log.debug(f'{self.full_name}: задержка {round(delay, 3)}')
         self.events.append(time.time()+delay)
         del self.events[0]
@@ -24,3 +31,81 @@ class Limiter:
     @property
     def is_old(self):
         return not self.static and time.time() - self.events[-1] >= self.period
+
+
+class TokenBucketLimiter:
+    # GCRA: constant memory and time per call, amount actions per period on average with bursts of up to burst actions.
+    # Within any period at most amount+burst-1 actions are allowed, so burst=1 is never looser than Limiter.
+
+    def __init__(self, controller, amount, period, burst=1, static=True, name=None):
+        self.controller = controller
+        self.amount = amount
+        self.period = period
+        self.burst = burst
+        self.static = static
+        self.name = name
+        # Time between actions at the sustained rate and how far ahead of it the actions may go
+        self.interval = period / amount
+        self.tolerance = self.interval * (burst-1)
+        # Theoretical arrival time of the next action
+        self.tat = 0
+        self.full_name = 'лимитер' if not self.name else 'лимитер '+self.name
+        self.controller.log.debug(f'Создан {self.full_name} ({self.amount} событий за {self.period} секунд, до {self.burst} подряд)')
+
+    def reserve(self, tokens=1):
+        # Returns the delay after which all tokens may be used at once
+        if tokens > self.burst:
+            raise ValueError(f'Can not reserve {tokens} tokens at once, burst is {self.burst}')
+        now = time.monotonic()
+        start = max(now, self.tat + self.interval*(tokens-1) - self.tolerance)
+        self.tat = max(self.tat, start) + self.interval*tokens
+        return start - now
+
+    def get_delay(self, tokens=1):
+        # Like reserve, but without using the tokens
+        return max(self.tat + self.interval*(tokens-1) - self.tolerance - time.monotonic(), 0)
+
+    async def acquire(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            self.controller.log.debug(f'{self.full_name}: задержка {round(delay, 3)}')
+            await asyncio.sleep(delay)
+
+    async def __call__(self):
+        await self.acquire()
+
+    @property
+    def is_old(self):
+        return not self.static and time.monotonic() >= self.tat
+
+
+class LimiterRegistry:
+    # Limiters by key (e.g. chat id), created on demand and evicted by sweep once they are old
+
+    def __init__(self, factory):
+        # Called with the key to create a limiter, which should be created with static=False
+        self.factory = factory
+        self.limiters = {}
+        self.evicted = 0
+
+    def get(self, key):
+        limiter = self.limiters.get(key)
+        if limiter is None:
+            limiter = self.factory(key)
+            self.limiters[key] = limiter
+        return limiter
+
+    def sweep(self, keep=()):
+        # An old limiter has no delay to impose, so a new one will behave the same way.
+        # Keys in keep are still in use, e.g. queued messages hold their limiters.
+        old_keys = [key for key, limiter in self.limiters.items() if limiter.is_old and key not in keep]
+        for key in old_keys:
+            del self.limiters[key]
+        self.evicted += len(old_keys)
+        return old_keys
+
+    def __contains__(self, key):
+        return key in self.limiters
+
+    def __len__(self):
+        return len(self.limiters)
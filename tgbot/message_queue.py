@@ -0,0 +1,115 @@
+import asyncio
+from collections import deque
+import enum
+
+
+class LaneState(enum.Enum):
+    # Has a message to send and is in the round-robin queue of its priority
+    READY = enum.auto()
+    # Has a message to send, but the chat limiter does not allow it yet
+    WAITING = enum.auto()
+    # Its message is being sent, the next one waits for it
+    SENDING = enum.auto()
+
+
+class QueuedMessage:
+    # What is needed to send a message, the api call is only made when the message is taken from its lane.
+    # Parts of a long message share args and kwargs.
+    __slots__ = ('message_id', 'chat_id', 'priority', 'text', 'args', 'kwargs', 'finish_event', 'store_id')
+
+    def __init__(self, message_id, chat_id, priority, text, args, kwargs, finish_event=None, store_id=None):
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.priority = priority
+        self.text = text
+        self.args = args
+        self.kwargs = kwargs
+        self.finish_event = finish_event
+        # Id in the MessageStore, None if the message is not stored
+        self.store_id = store_id
+
+
+class MessageLane:
+    # FIFO of the messages to one chat with one priority
+    __slots__ = ('chat_id', 'priority', 'items', 'state', 'timer')
+
+    def __init__(self, chat_id, priority):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.items = deque()
+        self.state = None
+        self.timer = None
+
+
+class MessageQueue:
+    # Per-chat lanes, served round-robin within every priority.
+    # A lane sends one message at a time, so the messages of a chat go in order,
+    # and it is not offered to the sender while the chat limiter would make it wait,
+    # so a busy chat does not hold the concurrency shared with the other chats.
+
+    def __init__(self, priorities, get_delay):
+        # Called with a chat id, returns seconds until a message may be sent to the chat
+        self.get_delay = get_delay
+        # (chat id, priority) -> lane, empty lanes are removed
+        self.lanes = {}
+        # Priority -> lanes ready to send their next message
+        self.ready = {priority: deque() for priority in priorities}
+        # Set when a lane becomes ready, the sender also sets it when a message is sent
+        self.event = asyncio.Event()
+        # Loop of the sender, set by start, the timers of waiting lanes run in it
+        self.loop = None
+
+    def start(self, loop):
+        self.loop = loop
+
+    def put(self, chat_id, priority, item):
+        lane = self.lanes.get((chat_id, priority))
+        if lane is None:
+            lane = MessageLane(chat_id, priority)
+            self.lanes[(chat_id, priority)] = lane
+        lane.items.append(item)
+        if lane.state is None:
+            self.schedule(lane)
+
+    def schedule(self, lane):
+        delay = self.get_delay(lane.chat_id)
+        # Before the start the lane is just ready, pop checks the delay again
+        if delay > 0 and self.loop is not None:
+            lane.state = LaneState.WAITING
+            lane.timer = self.loop.call_later(delay, self.schedule, lane)
+            return
+        lane.state = LaneState.READY
+        lane.timer = None
+        self.ready[lane.priority].append(lane)
+        self.event.set()
+
+    def pop(self, priority):
+        # The next message of the first ready lane, None if there is none
+        ready = self.ready[priority]
+        while ready:
+            lane = ready.popleft()
+            # The chat limiter may have been used since the lane became ready, e.g. by another priority
+            if self.get_delay(lane.chat_id) > 0:
+                self.schedule(lane)
+                continue
+            lane.state = LaneState.SENDING
+            return lane.items.popleft()
+
+    def done(self, chat_id, priority):
+        # The message taken from the lane is sent or failed, the lane goes to the end of the round-robin queue
+        lane = self.lanes[(chat_id, priority)]
+        if lane.items:
+            self.schedule(lane)
+        else:
+            del self.lanes[(chat_id, priority)]
+
+    def close(self):
+        for lane in self.lanes.values():
+            if lane.timer is not None:
+                lane.timer.cancel()
+
+    def count(self, state):
+        return sum(lane.state == state for lane in self.lanes.values())
+
+    def __len__(self):
+        return len(self.lanes)
@@ -0,0 +1,73 @@
+import pickle
+import sqlite3
+
+# How often appended and sent messages are written to the file, in seconds
+MESSAGE_STORE_FLUSH_INTERVAL = 0.1
+# Messages waiting to be written, beyond it new messages stay only in memory until the file is writable again
+MAX_BUFFERED_MESSAGES = 10000
+
+
+class MessageStore:
+    # Queued outgoing messages in a local SQLite file, so that they survive a restart of the bot.
+    # Appends and acknowledgements of sent messages are buffered and written by flush in one transaction,
+    # a message sent before the flush is never written at all.
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # Committed messages survive a crash of the bot, only a crash of the system may lose the last ones
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            'id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, priority INTEGER NOT NULL, '
+            'text TEXT NOT NULL, arguments BLOB NOT NULL)'
+        )
+        self.connection.commit()
+        self.last_id = self.connection.execute('SELECT coalesce(max(id), 0) FROM messages').fetchone()[0]
+        # Id -> row not yet written
+        self.appended = {}
+        # Ids of written rows to delete
+        self.acked = []
+
+    def append(self, message):
+        # Returns the id of the stored message, None if its arguments can not be pickled or the buffer is full
+        if len(self.appended) >= MAX_BUFFERED_MESSAGES:
+            return None
+        try:
+            arguments = pickle.dumps((message.args, message.kwargs))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+        self.last_id += 1
+        self.appended[self.last_id] = (self.last_id, message.chat_id, message.priority, message.text, arguments)
+        return self.last_id
+
+    def ack(self, message_id):
+        if self.appended.pop(message_id, None) is None:
+            self.acked.append((message_id,))
+
+    def flush(self):
+        # On an error the transaction is rolled back and the buffers are kept for the next flush
+        if not self.appended and not self.acked:
+            return
+        with self.connection:
+            self.connection.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?)', self.appended.values())
+            self.connection.executemany('DELETE FROM messages WHERE id = ?', self.acked)
+        self.appended = {}
+        self.acked = []
+
+    def load(self):
+        # Yields (id, chat_id, priority, text, args, kwargs) of the stored messages in the order they were queued
+        for message_id, chat_id, priority, text, arguments in self.connection.execute('SELECT * FROM messages ORDER BY id'):
+            args, kwargs = pickle.loads(arguments)
+            yield message_id, chat_id, priority, text, args, kwargs
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.connection.close()
+
+    def __len__(self):
+        # Buffered changes
+        return len(self.appended) + len(self.acked)
@@ -1,81 +1,87 @@
 import asyncio
 from collections import OrderedDict
+import functools
+import os
+import sqlite3
 
 from pyrogram.enums.parse_mode import ParseMode
 from pyrogram.utils import get_peer_type
 
 from tgbot.helpers import split_text
-from tgbot.limiter import Limiter
-from tgbot.helpers.prioritized_item import PrioritizedItem
+from tgbot.limiter import LIMITER_SWEEP_INTERVAL, LimiterRegistry, TokenBucketLimiter
+from tgbot.message_queue import MessageQueue, QueuedMessage
+from tgbot.message_store import MAX_BUFFERED_MESSAGES, MESSAGE_STORE_FLUSH_INTERVAL, MessageStore
 
 
 class TGBotMessagesMixin:
 
     def __init__(self):
-        self.message_queue = asyncio.PriorityQueue()
         self.message_id = 1
-        self.global_message_limiter = Limiter(
+        # The bursts are as big as the amounts, like the sliding windows of Limiter allowed
+        self.global_message_limiter = TokenBucketLimiter(
             self,
             30,
             1,
+            burst=30,
             name='broadcast_messages'
         )
-        self.message_limiters = {}
-        self.message_event_chains = {}
+        # Chat id -> limiter, idle ones are evicted by message_limiter_sweeper
+        self.message_limiters = LimiterRegistry(self.create_message_limiter)
         self.messages_info = OrderedDict()
         for priority in range(1, 4):
             self.messages_info[priority] = {'pending': 0, 'processing': 0}
+        self.message_queue = MessageQueue(self.messages_info, self.get_message_delay)
+        # Optional, queued messages are kept in this SQLite file and sent after a restart
+        self.message_queue_path = os.getenv('MESSAGE_QUEUE_PATH')
+        self.message_store = None
         super().__init__()
 
     def get_default_chat_id(self):
         pass
 
+    def create_message_limiter(self, chat_id):
+        if get_peer_type(chat_id) == 'user':
+            return TokenBucketLimiter(self, 3, 1, burst=3, name=f'user_{chat_id}', static=False)
+        return TokenBucketLimiter(self, 20, 60, burst=20, name=f'chat_{chat_id}', static=False)
+
+    def get_message_delay(self, chat_id):
+        return self.message_limiters.get(chat_id).get_delay()
+
     def get_message_texts(self, text, title='', **kwargs):
         return split_text.split_text_by_units(header=title, body=text, max_part_length=4096, **kwargs)
 
+    def is_message_loop_thread(self):
+        loop = self.message_queue.loop
+        if loop is None:
+            return True
+        try:
+            return asyncio.get_running_loop() is loop
+        except RuntimeError:
+            return False
+
     def send_message_sync(self, text, /, chat_id=None, *args, priority=2, blocking=False, **kwargs):
+        if not self.is_message_loop_thread():
+            # E.g. a log record from another thread, the queue is only changed in the loop of the sender.
+            # Nothing can wait for the message there, so the sending is never blocking
+            self.message_queue.loop.call_soon_threadsafe(
+                functools.partial(self.send_message_sync, text, chat_id, *args, priority=priority, **kwargs)
+            )
+            return
         chat_id = chat_id or self.get_default_chat_id()
-        if chat_id not in self.message_limiters:
-            if get_peer_type(chat_id) == 'user':
-                limiter = Limiter(self, 3, 1, name=f'user_{chat_id}', static=False)
-            else:
-                limiter = Limiter(self, 20, 60, name=f'chat_{chat_id}', static=False)
-            self.message_limiters[chat_id] = limiter
-        else:
-            limiter = self.message_limiters[chat_id]
-        kwargs['limiters'] = [self.global_message_limiter, limiter]
-        event_chain_key = (chat_id, priority)
-        if event_chain_key not in self.message_event_chains:
-            event_chain = {}
-        else:
-            event_chain = self.message_event_chains[event_chain_key]
         info = self.messages_info[priority]
         texts = self.get_message_texts(text, title=kwargs.get('title', ''))
         self.log.debug(f'Постановка {len(texts)} частей сообщения в очередь с приоритетом {priority} ({"блокирующая" if blocking else "неблокирующая"} отправка, текущий id {self.message_id})')
         for i, text in enumerate(texts):
-            event_chain['current_invoke_event'] = asyncio.Event()
-            new_event_chain = {'previous_invoke_event': event_chain['current_invoke_event']}
-            self.message_event_chains[event_chain_key] = new_event_chain
-            send_message_coroutine = self.app.send_message(
-                chat_id,
-                text,
-                *args,
-                **kwargs|event_chain
-            )
             finish_event = None
             if blocking and i == len(texts)-1:
                 finish_event = asyncio.Event()
-            message_data = {
-                'coroutine': send_message_coroutine,
-                'priority': priority,
-                'message_id': self.message_id,
-                'chat_id': chat_id,
-                'ignore_errors': kwargs.get('ignore_errors', False),
-                'finish_event': finish_event,
-                'current_invoke_event': event_chain['current_invoke_event'],
-            }
-            event_chain = new_event_chain
-            self.message_queue.put_nowait(PrioritizedItem(priority, self.message_id, message_data))
+            message = QueuedMessage(self.message_id, chat_id, priority, text, args, kwargs, finish_event)
+            if self.message_store is not None:
+                message.store_id = self.message_store.append(message)
+                if message.store_id is None and len(self.message_store.appended) < MAX_BUFFERED_MESSAGES:
+                    self.log.warning(f'Сообщение {self.message_id} не может быть сохранено в {self.message_store.path}, при перезапуске оно будет потеряно')
+            # Messages of a chat are sent one by one in this order
+            self.message_queue.put(chat_id, priority, message)
             info['pending'] += 1
             self.message_id += 1
         self.log.debug(f'Сообщения поставлены в очередь (текущий id {self.message_id})')
@@ -99,69 +105,114 @@ class TGBotMessagesMixin:
                 **kwargs,
             )
 
-    async def message_sender(self, max_concurrent_sendings_per_priority):
-        def could_get_next_item():
-            next_item_priority = None
-            next_item_priority_queue_size = None
-            first_full_queue_priority = None
-            for priority, info in self.messages_info.items():
-                if next_item_priority is None and info['pending'] > 0:
-                    next_item_priority = priority
-                    next_item_priority_queue_size = info['processing']
-                if first_full_queue_priority is None and info['processing'] == max_concurrent_sendings_per_priority:
-                    first_full_queue_priority = priority
-                if next_item_priority is not None and first_full_queue_priority is not None:
-                    break
-            if first_full_queue_priority is None:
-                return True
-            if next_item_priority is None:
-                return False
-            if next_item_priority_queue_size >= max_concurrent_sendings_per_priority:
-                return False
-            return True
-        message_tasks = []
-        get_message_task = None
+    def sweep_message_limiters(self):
+        # Chats with queued messages keep their limiters
+        busy_chats = {chat_id for chat_id, priority in self.message_queue.lanes}
+        evicted = self.message_limiters.sweep(keep=busy_chats)
+        if evicted:
+            self.log.debug(f'Удалено {len(evicted)} неактивных лимитеров, осталось {len(self.message_limiters)}')
+
+    async def message_limiter_sweeper(self, interval=LIMITER_SWEEP_INTERVAL):
         while True:
-            if not get_message_task and could_get_next_item():
-                get_message_task = asyncio.create_task(self.message_queue.get())
-                message_tasks.append(get_message_task)
+            await asyncio.sleep(interval)
+            self.sweep_message_limiters()
+
+    def open_message_store(self):
+        # Messages left from the previous run go first, in the order they were queued
+        self.message_store = MessageStore(self.message_queue_path)
+        count = 0
+        for store_id, chat_id, priority, text, args, kwargs in self.message_store.load():
+            self.message_queue.put(chat_id, priority, QueuedMessage(self.message_id, chat_id, priority, text, args, kwargs, store_id=store_id))
+            self.messages_info[priority]['pending'] += 1
+            self.message_id += 1
+            count += 1
+        self.log.info(f'Очередь сообщений хранится в {self.message_queue_path}, восстановлено сообщений: {count}')
+
+    async def message_store_writer(self, interval=MESSAGE_STORE_FLUSH_INTERVAL):
+        # Errors and the full buffer are logged once until the file is writable again
+        failing = False
+        full = False
+        while True:
+            await asyncio.sleep(interval)
             try:
-                done_tasks, pending_tasks = await asyncio.wait(message_tasks, return_when=asyncio.FIRST_COMPLETED)
-            except asyncio.CancelledError:
-                [t.cancel() for t in message_tasks]
-                raise
-            for task in done_tasks:
-                message_tasks.remove(task)
-                if task == get_message_task:
-                    get_message_task = None
-                    item = task.result()
-                    while True:
-                        priority = item.priority
-                        message_id = item.id
-                        message_data = item.item
-                        self.log.debug(f'Создаётся задача для отправки сообщения в чат {message_data["chat_id"]} с приоритетом {priority}, id {message_id}')
-                        message_task = asyncio.create_task(message_data['coroutine'])
-                        message_task.message_data = message_data
-                        message_tasks.append(message_task)
-                        info = self.messages_info[priority]
-                        info['pending'] -= 1
-                        info['processing'] += 1
-                        if self.message_queue.empty() or not could_get_next_item():
+                self.message_store.flush()
+            except sqlite3.Error:
+                # The buffers are kept, the next interval retries
+                if not failing:
+                    self.log.exception(f'Не удалось записать очередь сообщений в {self.message_store.path}, изменений в памяти: {len(self.message_store)}:')
+                    failing = True
+                if not full and len(self.message_store.appended) >= MAX_BUFFERED_MESSAGES:
+                    self.log.warning(f'В памяти {MAX_BUFFERED_MESSAGES} несохранённых сообщений, новые сообщения не сохраняются в {self.message_store.path} и будут потеряны при перезапуске')
+                    full = True
+                continue
+            if failing:
+                self.log.info(f'Очередь сообщений снова записывается в {self.message_store.path}')
+                failing = False
+                full = False
+
+    def close_message_store(self):
+        # Messages which were not sent stay in the file
+        try:
+            self.message_store.close()
+        except sqlite3.Error:
+            self.log.exception(f'Не удалось записать очередь сообщений в {self.message_store.path}, изменений потеряно: {len(self.message_store)}:')
+        self.message_store = None
+
+    def start_message_task(self, message):
+        self.log.debug(f'Создаётся задача для отправки сообщения в чат {message.chat_id} с приоритетом {message.priority}, id {message.message_id}')
+        limiters = [self.global_message_limiter, self.message_limiters.get(message.chat_id)]
+        message_task = asyncio.create_task(self.app.send_message(message.chat_id, message.text, *message.args, **message.kwargs|{'limiters': limiters}))
+        message_task.message = message
+        info = self.messages_info[message.priority]
+        info['pending'] -= 1
+        info['processing'] += 1
+        return message_task
+
+    def finish_message_task(self, task):
+        message = task.message
+        result = None
+        try:
+            result = task.result()
+        except Exception:
+            (self.log.info if message.kwargs.get('ignore_errors', False) else self.log.error)(
+                f'Необработанное исключение при отправке сообщения {message.message_id}:',
+                exc_info=True
+            )
+        finally:
+            self.messages_info[message.priority]['processing'] -= 1
+            self.message_queue.done(message.chat_id, message.priority)
+            # Failed messages are not sent again after a restart either
+            if message.store_id is not None and self.message_store is not None:
+                self.message_store.ack(message.store_id)
+            if message.finish_event:
+                message.finish_event.message = result
+                message.finish_event.set()
+
+    async def message_sender(self, max_concurrent_sendings_per_priority):
+        self.message_queue.start(asyncio.get_running_loop())
+        message_tasks = set()
+        def on_message_task_done(task):
+            message_tasks.discard(task)
+            if task.cancelled():
+                return
+            self.finish_message_task(task)
+            # A sending slot is free
+            self.message_queue.event.set()
+        try:
+            while True:
+                self.message_queue.event.clear()
+                for priority, info in self.messages_info.items():
+                    while info['processing'] < max_concurrent_sendings_per_priority:
+                        message = self.message_queue.pop(priority)
+                        if message is None:
                             break
-                        item = self.message_queue.get_nowait()
-                    continue
-                result = None
-                try:
-                    message_data = task.message_data
-                    result = task.result()
-                except Exception:
-                    message_data['current_invoke_event'].set()
-                    (self.log.info if message_data['ignore_errors'] else self.log.error)(
-                        f'Необработанное исключение при отправке сообщения {message_data["message_id"]}:',
-                        exc_info=True
-                    )
-                finally:
-                    self.messages_info[message_data['priority']]['processing'] -= 1
-                    if message_data['finish_event']:
-                        message_data['finish_event'].message = result
-                        message_data['finish_event'].set()
+                        message_task = self.start_message_task(message)
+                        message_task.add_done_callback(on_message_task_done)
+                        message_tasks.add(message_task)
+                    # Lower priorities wait while a higher one has more to send than it may send at once
+                    if self.message_queue.ready[priority]:
+                        break
+                await self.message_queue.event.wait()
+        finally:
+            [t.cancel() for t in message_tasks]
+            self.message_queue.close()
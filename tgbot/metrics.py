@@ -0,0 +1,250 @@
+import asyncio
+from bisect import bisect_left
+import os
+
+from pyrogram import filters
+from pyrogram.enums import ParseMode
+
+from tgbot.handler_decorators import on_message
+from tgbot.message_queue import LaneState
+
+# Upper bounds of the histogram buckets in nanoseconds, from 50us to 10s, the last bucket is unbounded
+LATENCY_BUCKETS = [
+    bound * 10**exponent
+    for exponent in range(4, 10)
+    for bound in (5, 10, 25)
+][:-1]
+NS_IN_MS = 10**6
+NS_IN_S = 10**9
+METRICS_HOST = '127.0.0.1'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+class Histogram:
+    # Fixed buckets, so observing a value is a bisect and two additions
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets)+1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the quantile, the max value for the last bucket
+        if not self.count:
+            return 0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+
+async def dev_filter(flt, client, message):
+    return message.from_user is not None and message.from_user.id in client.controller.dev_ids
+
+
+def format_histogram(name, histogram):
+    return (
+        f'{name}: {histogram.count}, '
+        f'mean {histogram.mean/NS_IN_MS:.2f}, '
+        f'p50 {histogram.quantile(0.5)/NS_IN_MS:.2f}, '
+        f'p99 {histogram.quantile(0.99)/NS_IN_MS:.2f}, '
+        f'max {histogram.max/NS_IN_MS:.2f}'
+    )
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class OpenMetricsWriter:
+    # Collects metric families in the OpenMetrics text format
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lines = []
+
+    def family(self, name, type, help):
+        name = f'{self.prefix}_{name}'
+        self.lines.append(f'# TYPE {name} {type}')
+        self.lines.append(f'# HELP {name} {help}')
+        return name
+
+    def sample(self, name, value, labels):
+        if labels:
+            labels = ','.join(f'{label}="{escape_label_value(value)}"' for label, value in labels.items())
+            name = f'{name}{{{labels}}}'
+        self.lines.append(f'{name} {value}')
+
+    def gauge(self, name, help, values):
+        # values is a list of (labels, value) pairs
+        name = self.family(name, 'gauge', help)
+        for labels, value in values:
+            self.sample(name, value, labels)
+
+    def counter(self, name, help, values):
+        name = self.family(name, 'counter', help)
+        for labels, value in values:
+            self.sample(f'{name}_total', value, labels)
+
+    def histogram(self, name, help, histograms):
+        # histograms is a list of (labels, Histogram) pairs, values are converted from nanoseconds to seconds
+        name = self.family(name, 'histogram', help)
+        for labels, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                self.sample(f'{name}_bucket', cumulative, labels | {'le': bound/NS_IN_S})
+            self.sample(f'{name}_bucket', histogram.count, labels | {'le': '+Inf'})
+            self.sample(f'{name}_count', histogram.count, labels)
+            self.sample(f'{name}_sum', histogram.sum/NS_IN_S, labels)
+
+    def render(self):
+        return '\n'.join(self.lines + ['# EOF', ''])
+
+
+class TGBotMetricsMixin:
+
+    def __init__(self):
+        # Optional, the metrics http server is not started without it
+        self.metrics_port = os.getenv('METRICS_PORT')
+        self.metrics_port = int(self.metrics_port) if self.metrics_port else None
+        super().__init__()
+
+    def format_metrics(self):
+        dispatcher = self.app.dispatcher
+        lines = ['Время в мс.', format_histogram('Обновления', dispatcher.update_latency), '', 'Категории:']
+        for category, histogram in dispatcher.category_latency.items():
+            lines.append(format_histogram(category.name, histogram))
+        lines.append('')
+        lines.append('Обработчики по суммарному времени:')
+        handlers = sorted(dispatcher.handler_latency.items(), key=lambda item: item[1].sum, reverse=True)
+        for name, histogram in handlers:
+            lines.append(format_histogram(name, histogram))
+        if dispatcher.handler_exceptions:
+            lines.append('')
+            lines.append('Исключения:')
+            for name, count in dispatcher.handler_exceptions.most_common():
+                lines.append(f'{name}: {count}')
+        queue = dispatcher.updates_queue
+        lines.append('')
+        lines.append(f'Очередь обновлений: {queue.qsize()}, максимум {queue.max_qsize} (по очередям: {", ".join(str(lane.qsize()) for lane in queue.lanes)})')
+        lines.append('Ожидание в очереди:')
+        for priority, histogram in queue.wait_histograms.items():
+            lines.append(format_histogram(priority.name, histogram))
+        if dispatcher.filter_check_time:
+            lines.append('')
+            lines.append('Фильтры (вычислений / из кеша / мс):')
+            for name, time in dispatcher.filter_check_time.most_common():
+                lines.append(f'{name}: {dispatcher.filter_evaluations[name]} / {dispatcher.filter_cache_hits[name]} / {time/NS_IN_MS:.2f}')
+        return '\n'.join(lines)
+
+    def collect_metrics(self, writer):
+        # Can be extended (overridden with a call to super().collect_metrics) to export application metrics
+        writer.gauge('messages_pending', 'Queued outgoing messages', [
+            ({'priority': priority}, info['pending']) for priority, info in self.messages_info.items()
+        ])
+        writer.gauge('messages_processing', 'Outgoing messages being sent', [
+            ({'priority': priority}, info['processing']) for priority, info in self.messages_info.items()
+        ])
+        writer.gauge('message_limiters', 'Per-chat message limiters', [({}, len(self.message_limiters))])
+        writer.counter('message_limiters_evicted', 'Idle per-chat message limiters evicted', [({}, self.message_limiters.evicted)])
+        writer.gauge('message_lanes', 'Per-chat outgoing message lanes', [({}, len(self.message_queue))])
+        writer.gauge('message_lanes_waiting', 'Per-chat message lanes waiting for their chat limiter', [({}, self.message_queue.count(LaneState.WAITING))])
+        if self.message_store is not None:
+            writer.gauge('message_store_buffered', 'Queued and sent messages not yet written to the message queue file', [({}, len(self.message_store))])
+        writer.gauge('async_tasks', 'Tasks started with add_task', [({}, len(self.async_tasks))])
+        writer.gauge('batch_writer_rows', 'Rows waiting in batch writers', [
+            ({'table': batch_writer.name}, batch_writer.queue.qsize() + len(batch_writer.rows))
+            for batch_writer in self.batch_writers
+        ])
+        writer.counter('batch_writer_dropped_rows', 'Rows lost by batch writers because of a full queue or failed writes', [
+            ({'table': batch_writer.name}, batch_writer.dropped)
+            for batch_writer in self.batch_writers
+        ])
+        writer.counter('degradations', 'Degradations because of overload', [
+            ({'name': name}, count) for name, count in self.degradations.items()
+        ])
+        dispatcher = self.app.dispatcher
+        queue = getattr(dispatcher, 'updates_queue', None)
+        if queue is not None:
+            writer.gauge('updates_queued', 'Updates waiting in the dispatcher queue', [
+                ({'lane': number}, lane.qsize()) for number, lane in enumerate(queue.lanes)
+            ])
+            writer.gauge('updates_queued_max', 'Peak size of the dispatcher queue', [({}, queue.max_qsize)])
+            writer.gauge('updates_overloaded', 'Whether the dispatcher queue is overloaded', [({}, int(queue.overloaded))])
+            writer.counter('updates_shed', 'Bulk updates shed while overloaded', [({}, queue.shed_count)])
+            writer.counter('updates_starvation', 'Bulk updates taken before waiting interactive ones', [({}, queue.starvation_count)])
+            writer.histogram('update_wait_seconds', 'Time spent by updates in the dispatcher queue', [
+                ({'priority': priority.name}, histogram) for priority, histogram in queue.wait_histograms.items()
+            ])
+        writer.histogram('update_duration_seconds', 'Update processing time', [({}, dispatcher.update_latency)])
+        writer.histogram('category_duration_seconds', 'Category processing time', [
+            ({'category': category.name}, histogram) for category, histogram in dispatcher.category_latency.items()
+        ])
+        writer.histogram('handler_duration_seconds', 'Handler callback time', [
+            ({'handler': name}, histogram) for name, histogram in dispatcher.handler_latency.items()
+        ])
+        writer.counter('handler_exceptions', 'Unhandled exceptions in handlers and their filters', [
+            ({'handler': name}, count) for name, count in dispatcher.handler_exceptions.items()
+        ])
+        pool = self.db_engine.pool
+        # Only QueuePool (the default for server databases) has these counters
+        if hasattr(pool, 'checkedout'):
+            writer.gauge('db_pool_size', 'Size of the database connection pool', [({}, pool.size())])
+            writer.gauge('db_pool_checked_out', 'Database connections in use', [({}, pool.checkedout())])
+            writer.gauge('db_pool_overflow', 'Database connections above the pool size', [({}, pool.overflow())])
+
+    def format_openmetrics(self):
+        writer = OpenMetricsWriter(self.bot_name)
+        self.collect_metrics(writer)
+        return writer.render()
+
+    async def handle_metrics_request(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            # Headers are not used
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, content_type, body = '200 OK', OPENMETRICS_CONTENT_TYPE, self.format_openmetrics()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain; charset=utf-8', 'Not found\n'
+            body = body.encode('utf-8')
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception:
+            self.log.exception('Необработанное исключение при обработке запроса метрик:')
+        finally:
+            writer.close()
+
+    async def metrics_server(self):
+        server = await asyncio.start_server(self.handle_metrics_request, METRICS_HOST, self.metrics_port)
+        self.log.info(f'Метрики доступны по адресу http://{METRICS_HOST}:{self.metrics_port}/metrics')
+        async with server:
+            await server.serve_forever()
+
+    @on_message(filters.command('metrics') & filters.private & filters.create(dev_filter))
+    async def metrics_handler(self, message):
+        await self.send_message(self.format_metrics(), message.chat.id, parse_mode=ParseMode.DISABLED)
@@ -0,0 +1,64 @@
+from io import BytesIO
+import struct
+import time
+
+from pyrogram.raw.core import TLObject
+
+# File header, the version is bumped on incompatible changes of the record layout
+MAGIC = b'TGUPDREC\x02'
+# Record: time, size of the rest of the record, numbers of users and chats, flags,
+# followed by the TL-serialized users, chats and the update itself
+RECORD_HEADER = struct.Struct('<dIHHB')
+# The update was shed while the queue was overloaded (see UpdateQueue), instead of being handled
+SHED = 1
+# How often the recording is flushed to the file, so that a crash or a kill loses at most this many seconds
+UPDATES_RECORD_FLUSH_INTERVAL = 1
+
+
+class UpdateRecorder:
+    # Appends raw (update, users, chats) packets to a file, see read_updates
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.count = 0
+
+    def write(self, packet, shed=False):
+        update, users, chats = packet
+        body = b''.join(
+            [user.write() for user in users.values()]
+            + [chat.write() for chat in chats.values()]
+            + [update.write()]
+        )
+        flags = SHED if shed else 0
+        self.file.write(RECORD_HEADER.pack(time.time(), len(body), len(users), len(chats), flags) + body)
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_updates(path):
+    # Yields (time, packet, shed) in the order they were recorded
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not an update recording')
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                # The last record may be cut off if the bot was killed
+                break
+            record_time, size, users_count, chats_count, flags = RECORD_HEADER.unpack(header)
+            body = file.read(size)
+            if len(body) < size:
+                break
+            body = BytesIO(body)
+            users = [TLObject.read(body) for _ in range(users_count)]
+            chats = [TLObject.read(body) for _ in range(chats_count)]
+            update = TLObject.read(body)
+            yield record_time, (update, {user.id: user for user in users}, {chat.id: chat for chat in chats}), bool(flags & SHED)
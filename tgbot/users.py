@@ -1,22 +1,42 @@
+import sqlalchemy
 from sqlalchemy import select
 
-from tgbot.db import db
+from tgbot.db import db, get_upsert_insert
 from tgbot.enums import Category
 from tgbot.group_manager import group_manager
 from tgbot.handler_decorators import on_callback_query, on_message
 from tgbot.helpers import ContextVarWrapper
+from tgbot.helpers.lru_cache import LRUCache
 
 current_user = ContextVarWrapper('current_user')
+USER_CACHE_SIZE = 100000
+
+
+class LightUser:
+    # Identity of the user without an ORM instance, enough for updates that do not change the user
+    __slots__ = ('id', 'user_id', 'pyrogram_user')
+
+    def __init__(self, id, user_id):
+        self.id = id
+        self.user_id = user_id
 
 
 class TGBotUsersMixin:
 
+    def __init__(self):
+        # Telegram user id -> primary key of the user row
+        self.user_cache = LRUCache(USER_CACHE_SIZE)
+        super().__init__()
+
     @on_callback_query(category=Category.INITIALIZE, group=group_manager.LOAD_USER)
     @on_message(category=Category.INITIALIZE, group=group_manager.LOAD_USER)
     async def load_user(self, update):
         if not update.from_user:
             return
-        user = await self.get_or_create_user(update.from_user.id)
+        if self.use_light_user(update):
+            user = await self.get_or_create_light_user(update.from_user.id)
+        else:
+            user = await self.get_or_create_user(update.from_user.id)
         user.pyrogram_user = update.from_user
         current_user.set_context_var_value(user)
 
@@ -27,15 +47,80 @@ class TGBotUsersMixin:
             return
         current_user.reset_context_var()
 
+    def use_light_user(self, update):
+        return False
+
+    async def insert_user(self, user_id, load=False):
+        # Only for users not found by select, the upsert covers a concurrent insert of the same user.
+        # Returns the id of the new user (its ORM instance if load is set), None on a conflict
+        stmt = get_upsert_insert(db, self.User).values(user_id=user_id).on_conflict_do_nothing(index_elements=['user_id'])
+        if db.bind.dialect.full_returning:
+            if load:
+                stmt = select(self.User).from_statement(stmt.returning(*self.User.__table__.columns))
+            else:
+                stmt = stmt.returning(self.User.id)
+            result = (await db.execute(stmt)).scalar()
+        else:
+            # SQLite in sqlalchemy 1.4 has no RETURNING, the id of the inserted row is known from the cursor
+            cursor = await db.execute(stmt)
+            result = cursor.inserted_primary_key[0] if cursor.rowcount > 0 else None
+            if load and result is not None:
+                result = await db.get(self.User, result)
+        if result is not None:
+            self.log.info(f'Создан пользователь {user_id}')
+        return result
+
+    def cache_user_id(self, user_id, pk, created):
+        if not created:
+            self.user_cache.set(user_id, pk)
+            return
+        # The insert can still be rolled back and its id reused, so a new id is cached after the commit
+        rolled_back = False
+        def after_rollback(session):
+            nonlocal rolled_back
+            rolled_back = True
+        def after_commit(session):
+            if not rolled_back:
+                self.user_cache.set(user_id, pk)
+        sqlalchemy.event.listen(db.sync_session, 'after_rollback', after_rollback, once=True)
+        sqlalchemy.event.listen(db.sync_session, 'after_commit', after_commit, once=True)
+
     async def get_or_create_user(self, user_id):
+        pk = self.user_cache.get(user_id)
+        if pk is not None:
+            # By primary key, so a user already loaded in this session costs no query
+            user = await db.get(self.User, pk)
+            if user is not None:
+                return user
+            self.user_cache.pop(user_id)
         stmt = select(self.User).where(
             self.User.user_id == user_id
         )
         user = (await db.execute(stmt)).scalar()
-        if not user:
-            user = self.User(user_id=user_id)
-            db.add(user)
-            await db.commit()
-            await db.refresh(user)  # To avoid some strange errors when accessing attributes
-            self.log.info(f'Создан пользователь {user_id}')
+        if user is not None:
+            self.cache_user_id(user_id, user.id, False)
+            return user
+        user = await self.insert_user(user_id, load=True)
+        created = user is not None
+        if not created:
+            # Inserted by a concurrent update
+            user = (await db.execute(stmt)).scalar()
+        self.cache_user_id(user_id, user.id, created)
         return user
+
+    async def get_or_create_light_user(self, user_id):
+        pk = self.user_cache.get(user_id)
+        if pk is None:
+            stmt = select(self.User.id).where(
+                self.User.user_id == user_id
+            )
+            pk = (await db.execute(stmt)).scalar()
+            created = False
+            if pk is None:
+                pk = await self.insert_user(user_id)
+                created = pk is not None
+                if not created:
+                    # Inserted by a concurrent update
+                    pk = (await db.execute(stmt)).scalar()
+            self.cache_user_id(user_id, pk, created)
+        return LightUser(pk, user_id)
@@ -1,9 +1,15 @@
-from collections import OrderedDict
+import asyncio
+from collections import Counter, OrderedDict, defaultdict
 import enum
 import inspect
+import logging
+import time
 
 import pyrogram
 
+from tgbot.metrics import Histogram
+from tgbot.wrappers.update_queue import UpdateQueue
+
 
 class Category(enum.IntEnum):
     INITIALIZE = enum.auto()
@@ -13,23 +19,128 @@ class Category(enum.IntEnum):
     FINALIZE = enum.auto()
 
 
+class FilterCache:
+    # Results of the filters for one update, each filter object is evaluated at most once
+
+    def __init__(self, dispatcher, client, update):
+        self.dispatcher = dispatcher
+        self.client = client
+        self.update = update
+        self.results = {}
+
+    async def check(self, handler):
+        if type(handler).check is not pyrogram.handlers.handler.Handler.check:
+            # Handlers like DeletedMessagesHandler check the filters in their own way
+            return await handler.check(self.client, self.update)
+        if not callable(handler.filters):
+            return True
+        return await self.evaluate(handler.filters)
+
+    async def evaluate(self, flt):
+        # Filters live as long as their handlers, so the ids are not reused during the update
+        key = id(flt)
+        cached = self.results.get(key)
+        if cached is not None:
+            result, name = cached
+            self.dispatcher.filter_cache_hits[name] += 1
+            return result
+        name = self.dispatcher.get_filter_name(flt)
+        if isinstance(flt, pyrogram.filters.AndFilter):
+            result = await self.evaluate(flt.base) and await self.evaluate(flt.other)
+        elif isinstance(flt, pyrogram.filters.OrFilter):
+            result = await self.evaluate(flt.base) or await self.evaluate(flt.other)
+        elif isinstance(flt, pyrogram.filters.InvertFilter):
+            result = not await self.evaluate(flt.base)
+        else:
+            start = time.perf_counter_ns()
+            if inspect.iscoroutinefunction(flt.__call__):
+                result = await flt(self.client, self.update)
+            else:
+                result = await self.client.loop.run_in_executor(self.client.executor, flt, self.client, self.update)
+            self.dispatcher.filter_check_time[name] += time.perf_counter_ns() - start
+            self.dispatcher.filter_evaluations[name] += 1
+        result = bool(result)
+        self.results[key] = (result, name)
+        return result
+
+
 class Dispatcher(pyrogram.dispatcher.Dispatcher):
+    # Replaced with ShardedUpdateQueue by BotController(sharded_updates=True)
+    updates_queue_class = UpdateQueue
+    # See UpdateQueue, set by BotController
+    high_watermark = None
+    low_watermark = None
+    overload_listener = None
+    # UpdateRecorder, set by BotController when UPDATES_RECORD_PATH is specified
+    recorder = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.categories = {c: OrderedDict() for c in Category}
+        # (category, handler type) -> groups of (handler, is raw handler) pairs, which can handle such updates
+        self.routes = {}
+        # Filter name -> number of evaluations / cache hits / evaluation time in nanoseconds
+        self.filter_evaluations = Counter()
+        self.filter_cache_hits = Counter()
+        self.filter_check_time = Counter()
+        # Processing time in nanoseconds of whole updates, of categories and of handler callbacks
+        self.update_latency = Histogram()
+        self.category_latency = {c: Histogram() for c in Category}
+        self.handler_latency = defaultdict(Histogram)
+        # Handler name -> number of unhandled exceptions in its filters or callback
+        self.handler_exceptions = Counter()
+
+    async def start(self):
+        if self.client.no_updates:
+            return
+        # The client puts updates with updates_queue.put_nowait
+        old_queue = self.updates_queue
+        self.updates_queue = self.updates_queue_class(
+            self.client.workers,
+            high_watermark=self.high_watermark,
+            low_watermark=self.low_watermark,
+            overload_listener=self.overload_listener,
+            recorder=self.recorder,
+        )
+        # Updates received while the client was connecting (or stopped) wait in the queue created by pyrogram
+        # (or the previous one), the queue class and its settings are only known after BotController.initialize
+        if isinstance(old_queue, UpdateQueue):
+            packets = old_queue.drain()
+        else:
+            packets = [old_queue.get_nowait() for _ in range(old_queue.qsize())]
+        for packet in packets:
+            self.updates_queue.put_nowait(packet)
+        if packets:
+            self.client.controller.log.info(f'В очередь перенесено обновлений, полученных до запуска обработчиков: {len(packets)}')
+        for worker in range(self.client.workers):
+            self.locks_list.append(asyncio.Lock())
+            self.handler_worker_tasks.append(
+                self.loop.create_task(self.handler_worker(self.locks_list[-1], worker))
+            )
+        self.client.controller.log.info(f'Запущено {self.client.workers} обработчиков обновлений ({self.updates_queue_class.__name__})')
+
+    async def stop(self):
+        if self.client.no_updates:
+            return
+        self.updates_queue.close()
+        for task in self.handler_worker_tasks:
+            await task
+        self.handler_worker_tasks.clear()
+        self.locks_list.clear()
+        self.client.controller.log.info(f'Остановлено {self.client.workers} обработчиков обновлений')
 
     async def add_handler(self, handler, category=Category.MAIN, group=0):
         if category not in self.categories:
             raise ValueError(f'Category {category} does not exist')
-        category = self.categories[category]
+        groups = self.categories[category]
         for lock in self.locks_list:
             await lock.acquire()
         try:
-            if group not in category:
-                category[group] = []
-            category[group].append(handler)
-            category = OrderedDict(sorted(category.items()))
+            if group not in groups:
+                groups[group] = []
+            groups[group].append(handler)
+            self.categories[category] = OrderedDict(sorted(groups.items()))
+            self.routes.clear()
         finally:
             for lock in self.locks_list:
                 lock.release()
@@ -46,6 +157,7 @@ class Dispatcher(pyrogram.dispatcher.Dispatcher):
             category[group].remove(handler)
             if not category[group]:
                 category.pop(group)
+            self.routes.clear()
         finally:
             for lock in self.locks_list:
                 lock.release()
@@ -59,42 +171,92 @@ class Dispatcher(pyrogram.dispatcher.Dispatcher):
         except Exception:
             return 'Unknown handler'
 
-    async def handle_category(self, category, packet, parsed_update, handler_type):
+    @staticmethod
+    def get_filter_name(flt):
+        if isinstance(flt, pyrogram.filters.AndFilter):
+            return 'AndFilter'
+        if isinstance(flt, pyrogram.filters.OrFilter):
+            return 'OrFilter'
+        if isinstance(flt, pyrogram.filters.InvertFilter):
+            return 'InvertFilter'
+        # Classes of the filters made by pyrogram.filters.create are named after their functions
+        return type(flt).__name__
+
+    def get_route(self, category, handler_type):
+        # Built once per handler type after each change of the handlers
+        key = (category, handler_type)
+        route = self.routes.get(key)
+        if route is None:
+            route = []
+            for group in self.categories[category].values():
+                handlers = []
+                for handler in group:
+                    if isinstance(handler, handler_type):
+                        handlers.append((handler, False))
+                    elif isinstance(handler, pyrogram.handlers.RawUpdateHandler):
+                        handlers.append((handler, True))
+                if handlers:
+                    route.append(handlers)
+            self.routes[key] = route
+        return route
+
+    async def handle_category(self, category, *args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return await self.run_category(category, *args, **kwargs)
+        finally:
+            self.category_latency[category].observe(time.perf_counter_ns() - start)
+
+    async def run_category(self, category, packet, parsed_update, handler_type, filter_cache=None):
         log = self.client.controller.log
-        log.debug(f'Выполняется обработка категории {category.name}')
-        for group in self.categories[category].values():
-            for handler in group:
+        # Debug logging is disabled while the bot is overloaded, so do not even format the messages
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug(f'Выполняется обработка категории {category.name}')
+        if filter_cache is None:
+            filter_cache = FilterCache(self, self.client, parsed_update)
+        for group in self.get_route(category, handler_type):
+            for handler, is_raw in group:
                 args = None
-                if isinstance(handler, handler_type):
+                if not is_raw:
                     try:
-                        if await handler.check(self.client, parsed_update):
+                        if await filter_cache.check(handler):
                             args = (parsed_update,)
                     except Exception:
+                        self.handler_exceptions[self.get_handler_name(handler)] += 1
                         log.exception(f'Необработанное исключение при проверке обработчика {self.get_handler_name(handler)}:')
                         return False
-                elif isinstance(handler, pyrogram.handlers.RawUpdateHandler):
+                else:
                     args = packet
                 if args is None:
                     continue
-                try:
+                if debug:
                     log.debug(f'Вызывается обработчик {self.get_handler_name(handler)}')
+                start = time.perf_counter_ns()
+                try:
                     await handler.callback(*args)
                 except pyrogram.StopPropagation:
                     return True
                 except pyrogram.ContinuePropagation:
                     continue
                 except Exception:
+                    self.handler_exceptions[self.get_handler_name(handler)] += 1
                     log.exception(f'В обработчике {self.get_handler_name(handler)} произошло необработанное исключение:')
                     return False
+                finally:
+                    self.handler_latency[self.get_handler_name(handler)].observe(time.perf_counter_ns() - start)
                 break
         return True
 
-    async def handler_worker(self, lock):
+    async def handler_worker(self, lock, worker=0):
         while True:
-            packet = await self.updates_queue.get()
+            packet = await self.updates_queue.get(worker)
             if packet is None:
                 break
+            start = time.perf_counter_ns()
             try:
+                if self.recorder is not None:
+                    self.recorder.write(packet)
                 update, users, chats = packet
                 parser = self.update_parsers.get(type(update), None)
                 parsed_update, handler_type = (
@@ -106,6 +268,7 @@ class Dispatcher(pyrogram.dispatcher.Dispatcher):
                     'packet': packet,
                     'parsed_update': parsed_update,
                     'handler_type': handler_type,
+                    'filter_cache': FilterCache(self, self.client, parsed_update),
                 }
                 async with lock:
                     if not await self.handle_category(Category.INITIALIZE, **kwargs):
@@ -118,3 +281,6 @@ class Dispatcher(pyrogram.dispatcher.Dispatcher):
                     await self.handle_category(Category.FINALIZE, **kwargs)
             except Exception:
                 self.client.controller.log.exception('Необработанное исключение при обработке обновления:')
+            finally:
+                self.updates_queue.task_done(packet)
+                self.update_latency.observe(time.perf_counter_ns() - start)
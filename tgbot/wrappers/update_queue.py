@@ -0,0 +1,278 @@
+import asyncio
+from collections import deque
+import enum
+import time
+
+from pyrogram import raw, utils
+
+from tgbot.metrics import Histogram
+
+# Bulk updates waiting longer than this are handled even if there are interactive ones
+STARVATION_TIMEOUT = 1
+
+CALLBACK_QUERY_UPDATES = (raw.types.UpdateBotCallbackQuery, raw.types.UpdateInlineBotCallbackQuery)
+
+
+class UpdatePriority(enum.IntEnum):
+    # Callback queries and private messages, someone is waiting for the answer
+    INTERACTIVE = enum.auto()
+    # Everything else, mostly group messages that are only counted
+    BULK = enum.auto()
+
+
+def get_chat_id(update):
+    # Chat of a raw update, None if the update is not bound to a chat
+    message = getattr(update, 'message', None)
+    peer = getattr(message, 'peer_id', None) or getattr(update, 'peer', None)
+    if peer is not None:
+        return utils.get_peer_id(peer)
+    if getattr(update, 'channel_id', None) is not None:
+        return utils.get_channel_id(update.channel_id)
+    if getattr(update, 'chat_id', None) is not None:
+        return -update.chat_id
+    return getattr(update, 'user_id', None)
+
+
+class Lane:
+    # FIFO for every priority, interactive updates go first unless bulk ones starve
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.items = {priority: deque() for priority in UpdatePriority}
+        self.event = asyncio.Event()
+
+    def put(self, priority, packet):
+        self.items[priority].append((time.monotonic(), packet))
+        self.event.set()
+
+    def pop(self):
+        now = time.monotonic()
+        interactive = self.items[UpdatePriority.INTERACTIVE]
+        bulk = self.items[UpdatePriority.BULK]
+        if bulk and (not interactive or now - bulk[0][0] >= self.queue.starvation_timeout):
+            if interactive:
+                self.queue.starvation_count += 1
+            priority = UpdatePriority.BULK
+        else:
+            priority = UpdatePriority.INTERACTIVE
+        put_time, packet = self.items[priority].popleft()
+        if packet is not None:
+            self.queue.record_wait(priority, now - put_time)
+        return packet
+
+    async def get(self):
+        while not self.qsize():
+            self.event.clear()
+            await self.event.wait()
+        return self.pop()
+
+    def qsize(self):
+        return sum(len(items) for items in self.items.values())
+
+    def release(self, packet):
+        # The update taken from the lane is handled
+        pass
+
+    def drain(self):
+        # Takes the queued updates as (put time, packet) pairs, the stop markers are dropped
+        items = [item for priority_items in self.items.values() for item in priority_items if item[1] is not None]
+        for priority_items in self.items.values():
+            priority_items.clear()
+        return items
+
+
+class ChatLane(Lane):
+    # Keeps the updates of every chat in the order of arrival, the priority only decides which chat goes next:
+    # a chat is in the queue of the priority of its oldest update, e.g. a button press in a group
+    # waits for the earlier messages of that group, but not for the messages of other groups.
+    # A chat is leased to the worker which took its update until the update is handled,
+    # so any free worker takes the next ready chat, and the updates of a chat are handled one by one.
+    # Updates without a chat are not ordered.
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        # self.items holds chat ids, chat id -> deque of (put time, priority, packet)
+        self.chats = {}
+        # Chats with an update being handled, they return to self.items on release
+        self.leased = set()
+        self.size = 0
+        # Workers to stop once the lane is empty
+        self.stops = 0
+
+    def put(self, priority, packet):
+        if packet is None:
+            self.stops += 1
+            self.event.set()
+            return
+        chat_id = get_chat_id(packet[0])
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = deque()
+        chat.append((time.monotonic(), priority, packet))
+        if len(chat) == 1 and chat_id not in self.leased:
+            self.items[priority].append(chat_id)
+        self.size += 1
+        self.event.set()
+
+    def file(self, chat_id):
+        # Behind the chats already waiting with the priority of its next update
+        chat = self.chats[chat_id]
+        if chat:
+            self.items[chat[0][1]].append(chat_id)
+            self.event.set()
+        else:
+            del self.chats[chat_id]
+
+    def ready(self):
+        # Stop markers are taken only when there is nothing left to handle
+        return any(self.items.values()) or (self.stops and not self.size)
+
+    def pop(self):
+        if not any(self.items.values()):
+            self.stops -= 1
+            return None
+        now = time.monotonic()
+        interactive = self.items[UpdatePriority.INTERACTIVE]
+        bulk = self.items[UpdatePriority.BULK]
+        if bulk and (not interactive or now - self.chats[bulk[0]][0][0] >= self.queue.starvation_timeout):
+            if interactive:
+                self.queue.starvation_count += 1
+            chat_id = bulk.popleft()
+        else:
+            chat_id = interactive.popleft()
+        put_time, priority, packet = self.chats[chat_id].popleft()
+        self.size -= 1
+        self.queue.record_wait(priority, now - put_time)
+        if chat_id is None:
+            self.file(chat_id)
+        else:
+            self.leased.add(chat_id)
+        if self.ready():
+            # Other waiting workers, e.g. for the stop markers once the last update is taken
+            self.event.set()
+        return packet
+
+    def release(self, packet):
+        chat_id = get_chat_id(packet[0])
+        if chat_id is None:
+            return
+        self.leased.discard(chat_id)
+        self.file(chat_id)
+
+    async def get(self):
+        while not self.ready():
+            self.event.clear()
+            await self.event.wait()
+        return self.pop()
+
+    def qsize(self):
+        return self.size + self.stops
+
+    def drain(self):
+        items = [(put_time, packet) for chat in self.chats.values() for put_time, priority, packet in chat]
+        self.chats.clear()
+        self.leased.clear()
+        for priority_items in self.items.values():
+            priority_items.clear()
+        self.size = 0
+        self.stops = 0
+        return items
+
+
+class UpdateQueue:
+    # One lane shared by all workers, like the queue in pyrogram
+
+    def __init__(self, workers, starvation_timeout=STARVATION_TIMEOUT, high_watermark=None, low_watermark=None, overload_listener=None, recorder=None):
+        self.workers = workers
+        self.starvation_timeout = starvation_timeout
+        # Above the high watermark the queue is overloaded until it shrinks to the low one
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark if low_watermark is not None else (high_watermark or 0) // 2
+        # Object with shed_update(packet) and set_overloaded(overloaded, queue_size) methods, e.g. the controller
+        self.overload_listener = overload_listener
+        # UpdateRecorder, shed updates never reach the workers, so they are recorded here
+        self.recorder = recorder
+        self.overloaded = False
+        # Bulk updates consumed by overload_listener.shed_update instead of being queued
+        self.shed_count = 0
+        # Priority -> number of updates, total and max time in the queue in seconds
+        self.wait_stats = {priority: {'count': 0, 'wait_time': 0.0, 'max_wait_time': 0.0} for priority in UpdatePriority}
+        # Priority -> histogram of the time in the queue in nanoseconds
+        self.wait_histograms = {priority: Histogram() for priority in UpdatePriority}
+        # The biggest number of queued updates so far
+        self.max_qsize = 0
+        # How many times a bulk update was taken before waiting interactive ones
+        self.starvation_count = 0
+        self.lanes = self.create_lanes()
+
+    def create_lanes(self):
+        return [Lane(self)]
+
+    def get_lane(self, packet):
+        return self.lanes[0]
+
+    def get_priority(self, packet):
+        update = packet[0]
+        if isinstance(update, CALLBACK_QUERY_UPDATES):
+            return UpdatePriority.INTERACTIVE
+        if isinstance(getattr(getattr(update, 'message', None), 'peer_id', None), raw.types.PeerUser):
+            return UpdatePriority.INTERACTIVE
+        return UpdatePriority.BULK
+
+    def record_wait(self, priority, wait_time):
+        stats = self.wait_stats[priority]
+        stats['count'] += 1
+        stats['wait_time'] += wait_time
+        stats['max_wait_time'] = max(stats['max_wait_time'], wait_time)
+        self.wait_histograms[priority].observe(int(wait_time * 10**9))
+
+    def set_overloaded(self, overloaded):
+        self.overloaded = overloaded
+        if self.overload_listener:
+            self.overload_listener.set_overloaded(overloaded, self.qsize())
+
+    def put_nowait(self, packet):
+        priority = self.get_priority(packet)
+        if self.high_watermark is not None:
+            if not self.overloaded and self.qsize() >= self.high_watermark:
+                self.set_overloaded(True)
+            # Interactive updates always get full service
+            if self.overloaded and priority == UpdatePriority.BULK and self.overload_listener and self.overload_listener.shed_update(packet):
+                self.shed_count += 1
+                if self.recorder is not None:
+                    self.recorder.write(packet, shed=True)
+                return
+        self.get_lane(packet).put(priority, packet)
+        self.max_qsize = max(self.max_qsize, self.qsize())
+
+    async def get(self, worker):
+        packet = await self.lanes[worker % len(self.lanes)].get()
+        if self.overloaded and self.qsize() <= self.low_watermark:
+            self.set_overloaded(False)
+        return packet
+
+    def task_done(self, packet):
+        # Called by the worker when it has finished with the update
+        self.get_lane(packet).release(packet)
+
+    def close(self):
+        # Stop the workers after all already queued updates
+        for worker in range(self.workers):
+            self.lanes[worker % len(self.lanes)].put(UpdatePriority.BULK, None)
+
+    def qsize(self):
+        return sum(lane.qsize() for lane in self.lanes)
+
+    def drain(self):
+        # Takes all queued updates in the order of arrival, e.g. to move them to another queue
+        items = [item for lane in self.lanes for item in lane.drain()]
+        items.sort(key=lambda item: item[0])
+        return [packet for put_time, packet in items]
+
+
+class ShardedUpdateQueue(UpdateQueue):
+    # Updates of a chat are handled one by one in the order of arrival, while different chats are handled in parallel
+    # by any free workers, so a slow chat holds only the worker handling it (see ChatLane)
+
+    def create_lanes(self):
+        return [ChatLane(self)]